@@ -0,0 +1,61 @@
+'''
+Benchmark of train_model_distributed() against the number of worker processes
+
+A random dataset in the layout of the real ones is generated and converted to the processed format
+(so that every worker memory-maps the same files), then one model is trained for a few epochs with
+each number of workers. Reported are the time per epoch, the training throughput in geometries per
+second and its speedup over the first worker count.
+
+Run with:
+    python benchmark_distributed.py --num-graphs 2000 --workers 1 2 4 8 16 32 --threads-per-worker 1
+'''
+import os
+import copy
+import argparse
+import tempfile
+
+import torch
+
+from distributed_training import *
+from benchmark_preprocessing import write_random_mat
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark data-parallel training")
+    parser.add_argument('--num-graphs', type = int, default = 2000)
+    parser.add_argument('--num-nodes', type = int, default = 2000, help = "Average number of nodes per mesh")
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8, 16, 32])
+    parser.add_argument('--threads-per-worker', type = int, default = 1)
+    parser.add_argument('--epochs', type = int, default = 2)
+    parser.add_argument('--batch-size', type = int, default = 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'random.mat')
+        write_random_mat(filename, args.num_graphs, args.num_nodes)
+        convert_matlab_dataset_parallel(filename, os.path.join(tmp, 'processed'), dtype = torch.float)
+        dataset = load_processed_dataset(os.path.join(tmp, 'processed'))
+        idxs_tr, idxs_val = get_split_indices(dataset)
+
+        torch.manual_seed(0)
+        initial = SSENet(dtype = torch.float)
+
+        print(f"{args.num_graphs} meshes, ~{args.num_nodes} nodes each, {os.cpu_count()} CPUs, "
+              f"{args.threads_per_worker} thread(s) per worker")
+        print("workers  s/epoch  geometries/s  speedup")
+        throughput = {}
+        for w in args.workers:
+            if w * args.threads_per_worker > os.cpu_count():
+                print(f"(warning: {w} workers x {args.threads_per_worker} threads oversubscribe the CPUs)")
+            _, loss_hist, _, total_time = train_model_distributed(copy.deepcopy(initial), dataset, idxs_tr, idxs_val,
+                                                                  num_workers = w, threads_per_worker = args.threads_per_worker,
+                                                                  epochs = args.epochs, batch_size = args.batch_size,
+                                                                  val_every = 'epoch', print_progress = False)
+            epoch_time = total_time / len(loss_hist)
+            throughput[w] = len(shard_indices(idxs_tr, w)[0]) * w / epoch_time
+            print(f"{w:7d} {epoch_time:8.2f} {throughput[w]:13.1f} {throughput[w] / throughput[args.workers[0]]:8.2f}",
+                  flush = True)
+
+
+if __name__ == '__main__':
+    main()
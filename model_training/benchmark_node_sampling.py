@@ -0,0 +1,53 @@
+'''
+Benchmark of training on sampled nodes (train_model(..., node_samples = ...)) against full-mesh training
+
+Synthetic datasets (see synthetic_data.py) of the same geometries are meshed at increasing refinement.
+On each, one model is trained on all nodes and one on a fixed number of sampled nodes per geometry
+(for each weighting), from the same initial weights and for the same number of epochs.
+Reported are the time per epoch and the median R2 on the test geometries (over all of their nodes).
+
+Run with:
+    python benchmark_node_sampling.py --mesh-sizes 2000 8000 32000 --node-samples 1000 --epochs 20
+'''
+import copy
+import argparse
+
+import numpy as np
+import torch
+
+from models import *
+from evaluation import evaluate_dataset
+from synthetic_data import synthetic_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark training on sampled nodes against full meshes")
+    parser.add_argument('--mesh-sizes', type = int, nargs = '+', default = [2000, 8000, 32000])
+    parser.add_argument('--num-graphs', type = int, default = 50)
+    parser.add_argument('--node-samples', type = int, default = 1000, help = "Nodes sampled per geometry and step")
+    parser.add_argument('--weightings', nargs = '+', choices = NODE_WEIGHTINGS, default = list(NODE_WEIGHTINGS))
+    parser.add_argument('--epochs', type = int, default = 20)
+    parser.add_argument('--batch-size', type = int, default = 1)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    initial = SSENet()
+    print(f"{args.num_graphs} geometries, {args.epochs} epochs, {args.node_samples} sampled nodes per geometry")
+    print(f"{'mesh size':>9s}  {'training':18s} {'s/epoch':>8s} {'test median R2':>15s}")
+    for n in args.mesh_sizes:
+        # The same seed gives the same geometries and fields at every refinement
+        dataset = synthetic_dataset(args.num_graphs, n)
+        idxs_tr, idxs_val = get_split_indices(dataset)
+        runs = [('all nodes', {})] + [(f'sampled, {w}', {'node_samples': args.node_samples, 'node_weighting': w})
+                                      for w in args.weightings]
+        for name, kwargs in runs:
+            random.seed(0)
+            model, loss_hist, _, total_time = train_model(copy.deepcopy(initial), dataset, idxs_tr, idxs_val,
+                                                          epochs = args.epochs, batch_size = args.batch_size,
+                                                          val_every = 'epoch', print_progress = False, **kwargs)
+            r2 = np.median(evaluate_dataset(model, dataset, idxs_val)['r2'])
+            print(f"{n:9d}  {name:18s} {total_time / len(loss_hist):8.2f} {r2:15.4f}", flush = True)
+
+
+if __name__ == '__main__':
+    main()
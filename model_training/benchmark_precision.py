@@ -0,0 +1,101 @@
+'''
+Benchmark of reduced floating point precision against the float64 baseline
+
+A float64 SSENet is trained briefly on synthetic geometries (see synthetic_data.py). The same weights are
+then run in float32, and in float32 with bfloat16 autocasting (predict(..., autocast_dtype=torch.bfloat16)),
+on held-out synthetic geometries. Reported, against the float64 predictions:
+- The largest relative difference: max |prediction - float64 prediction| / max |float64 prediction|, over geometries
+- The smallest R2 of a geometry's prediction, with the float64 prediction as the ground truth
+- The median time of one inference, and of one training step (forward, backward, Adam), on one larger mesh
+The table is printed in the layout of the README's "Numerical precision" section.
+
+Run with:
+    python benchmark_precision.py --num-graphs 40 --timing-nodes 5000 --threads 1
+'''
+import copy
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+from torch import optim
+
+from models import *
+from evaluation import get_r2
+from synthetic_data import synthetic_dataset
+
+
+def median_time(fn, repeat):
+    # The median wall time of fn(), in milliseconds, after one untimed warm-up call
+    fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times)) * 1000
+
+
+def training_step_time(model, data, repeat):
+    # The time of one optimizer step on 'data', from a copy of 'model' (in the model's dtype)
+    model = copy.deepcopy(model)
+    data = data.to(model_dtype(model))
+    opt = optim.Adam(model.parameters(), lr = 1e-4)
+    def step():
+        loss = batch_loss(model(data), data)
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+    return median_time(step, repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare float32 and bfloat16 with the float64 baseline")
+    parser.add_argument('--num-graphs', type = int, default = 40, help = "Held-out geometries compared")
+    parser.add_argument('--train-graphs', type = int, default = 40)
+    parser.add_argument('--num-nodes', type = int, default = 2000, help = "Approximate nodes per geometry")
+    parser.add_argument('--epochs', type = int, default = 5)
+    parser.add_argument('--timing-nodes', type = int, default = 5000, help = "Nodes of the mesh used for timings")
+    parser.add_argument('--repeat', type = int, default = 20)
+    parser.add_argument('--threads', type = int, default = 1)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    random.seed(0)
+    train = synthetic_dataset(args.train_graphs, args.num_nodes, seed = 0)
+    idxs_tr, idxs_val = get_split_indices(train)
+    model, *_ = train_model(SSENet(), train, idxs_tr, idxs_val, epochs = args.epochs, val_every = 'epoch',
+                            print_progress = False)
+    model.eval()
+    test = synthetic_dataset(args.num_graphs, args.num_nodes, seed = 1)
+    timing = synthetic_dataset(1, args.timing_nodes, seed = 2)[0]
+
+    model32 = copy.deepcopy(model).to(torch.float)
+    test32 = [data.to(torch.float) for data in test]
+    timing32 = timing.to(torch.float)
+    variants = [('float64 (baseline)', model, test, timing, None),
+                ('float32', model32, test32, timing32, None),
+                ('bfloat16 autocast (inference only)', model32, test32, timing32, torch.bfloat16)]
+
+    reference = [predict(model, data).numpy() for data in test]
+    print(f"{args.num_graphs} held-out geometries of ~{args.num_nodes} nodes; timings for one "
+          f"{len(timing.x)}-node mesh on {args.threads} thread(s)\n")
+    print("| Precision | Max. relative difference in prediction | Min. R2 vs. float64 | Inference | Training step |")
+    print("|---|---|---|---|---|")
+    for name, m, data, timing_data, autocast_dtype in variants:
+        preds = [predict(m, d, autocast_dtype).double().numpy() for d in data]
+        inference = median_time(lambda: predict(m, timing_data, autocast_dtype), args.repeat)
+        if m is model:
+            diff, r2 = '-', '-'
+        else:
+            diff = f"{max(np.max(np.abs(p - r)) / np.max(np.abs(r)) for p, r in zip(preds, reference)):.1e}"
+            r2 = f"{min(get_r2(r, p) for p, r in zip(preds, reference)):.4f}"
+        # Training under bfloat16 autocast is not supported by train_model()
+        step = '-' if autocast_dtype is not None else f"{training_step_time(m, timing_data, args.repeat):.0f} ms"
+        print(f"| {name} | {diff} | {r2} | {inference:.0f} ms | {step} |", flush = True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Benchmark of convert_matlab_dataset_parallel() against the number of worker processes
+
+A .mat file of random data in the layout of the real datasets is generated (conversion time
+does not depend on the values), converted with each number of workers, and the speedup over
+one worker is reported. The outputs of every run are checked to be identical.
+
+Run with:
+    python benchmark_preprocessing.py --num-graphs 2000 --workers 1 2 4 8 16
+'''
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from scipy import io
+
+from data_loading import *
+
+
+def write_random_mat(filename, num_graphs, num_nodes, seed = 0):
+    '''
+    write_random_mat: Writes a .mat file of random meshes, fields and SDFs, laid out like the real datasets
+    '''
+    rng = np.random.RandomState(seed)
+    cells = {name: np.empty((num_graphs, 1), dtype=object) for name in MAT_VARIABLES}
+    for i in range(num_graphs):
+        n = rng.randint(num_nodes // 2, 3 * num_nodes // 2)
+        cells['nodes'][i, 0] = rng.rand(2, n)
+        cells['elem'][i, 0] = rng.randint(1, n + 1, size=(3, 2 * n)).astype(float)
+        cells['stress'][i, 0] = rng.rand(n, 1) * 10000
+        cells['dt'][i, 0] = rng.rand(n, 1) - 0.5
+        cells['sdf'][i, 0] = rng.rand(64, 64) - 0.5
+    io.savemat(filename, cells)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark parallel dataset preprocessing")
+    parser.add_argument('--num-graphs', type = int, default = 2000)
+    parser.add_argument('--num-nodes', type = int, default = 2000, help = "Average number of nodes per mesh")
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'random.mat')
+        write_random_mat(filename, args.num_graphs, args.num_nodes)
+        spill_dir = os.path.join(tmp, 'spill')
+        os.makedirs(spill_dir)
+        StreamingMatDataset(filename, spill_dir = spill_dir) # Spill once, so every run times only the conversion
+
+        print(f"{args.num_graphs} meshes, ~{args.num_nodes} nodes each, {os.cpu_count()} CPUs")
+        print("workers    seconds    speedup")
+        times, reference = {}, None
+        for w in args.workers:
+            out = os.path.join(tmp, f'out_{w}')
+            start = time.perf_counter()
+            convert_matlab_dataset_parallel(filename, out, num_workers = w, spill_dir = spill_dir)
+            times[w] = time.perf_counter() - start
+            print(f"{w:7d} {times[w]:10.2f} {times[args.workers[0]] / times[w]:10.2f}", flush = True)
+
+            arrays = {name: np.load(os.path.join(out, name)) for name in sorted(os.listdir(out)) if name.endswith('.npy')}
+            if reference is None:
+                reference = arrays
+            elif any(not np.array_equal(reference[name], arrays[name]) for name in reference):
+                raise RuntimeError(f"The output with {w} workers differs from the output with {args.workers[0]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'''
+Benchmarks of the prediction pipeline on synthetic geometries (see synthetic_data.py)
+
+Times SSE construction, cvec/cvec_batch, tensor_interp2d/apply_interp2d, the forward and backward passes
+of SSENet/SSENetCustom, chunked inference, dataset loading and evaluation, across mesh sizes and batch sizes. The results
+are written as JSON, together with the versions and machine they were measured on, and can be compared
+with an earlier results file to spot regressions.
+
+Run with:
+    python benchmark_suite.py --mesh-sizes 1000 5000 20000 --batch-sizes 1 4 16 --output results.json
+    python benchmark_suite.py --compare results.json --output new_results.json
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import torch
+
+import spectral_np_utils
+from models import *
+from evaluation import evaluate_dataset
+from synthetic_data import *
+
+RESULTS_VERSION = 1
+
+
+def time_call(fn, repeat = 5, warmup = 1):
+    '''
+    time_call: Times a function of no arguments
+
+    Returns - Dictionary of the median, minimum and mean time in milliseconds over 'repeat' calls
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': float(np.median(times)), 'min_ms': float(np.min(times)),
+            'mean_ms': float(np.mean(times)), 'repeat': repeat}
+
+
+class Suite:
+    '''
+    This class runs the benchmarks, sharing the synthetic datasets between them
+
+    mesh_sizes - The approximate numbers of nodes per geometry to benchmark
+    batch_sizes - The numbers of geometries per batch to benchmark
+    num_graphs - The number of geometries in the datasets used for loading and evaluation
+    repeat - The number of timed calls of each benchmark
+    dtype - The floating point type of the data and models
+    '''
+    def __init__(self, mesh_sizes = (1000, 5000, 20000), batch_sizes = (1, 4, 16), num_graphs = 32,
+                 repeat = 5, dtype = torch.double):
+        self.mesh_sizes = mesh_sizes
+        self.batch_sizes = batch_sizes
+        self.num_graphs = num_graphs
+        self.repeat = repeat
+        self.dtype = dtype
+        self.datasets = {}
+        self.results = []
+
+    def dataset(self, mesh_size):
+        if mesh_size not in self.datasets:
+            num_graphs = max(self.num_graphs, max(self.batch_sizes))
+            self.datasets[mesh_size] = synthetic_dataset(num_graphs, mesh_size, dtype = self.dtype)
+        return self.datasets[mesh_size]
+
+    def record(self, benchmark, fn, **params):
+        result = {'benchmark': benchmark, **params, **time_call(fn, self.repeat)}
+        self.results.append(result)
+        print(f"{benchmark:28s} {json.dumps(params):60s} {result['median_ms']:10.3f} ms", flush = True)
+
+    def sse_construction(self):
+        for k in (25, 50):
+            def build():
+                with tempfile.TemporaryDirectory() as tmp:
+                    spectral_np_utils._basis_memo.clear()
+                    SSE(k = k, cache_dir = tmp)
+            self.record('sse_construction', build, k = k)
+            with tempfile.TemporaryDirectory() as tmp:
+                SSE(k = k, cache_dir = tmp)
+                def load():
+                    spectral_np_utils._basis_memo.clear()
+                    SSE(k = k, cache_dir = tmp)
+                self.record('sse_load_cached', load, k = k)
+
+    def cvec(self):
+        sse = SSE(k = 50)
+        rng = np.random.RandomState(0)
+        sdfs = np.stack([synthetic_geometry(rng, 200).sdf for _ in range(max(self.batch_sizes))])
+        self.record('cvec', lambda: sse.cvec(sdfs[0]))
+        for b in self.batch_sizes:
+            self.record('cvec_batch', lambda: sse.cvec_batch(sdfs[:b]), batch_size = b)
+
+    def interp(self):
+        torch.manual_seed(0)
+        grid = torch.rand(16, 8, 8, dtype = self.dtype)
+        for n in self.mesh_sizes:
+            pts = self.dataset(n)[0].x
+            op = interp2d_operator(pts, 8, 8, INTERP_EPSILON)
+            num_nodes = len(pts)
+            self.record('tensor_interp2d', lambda: tensor_interp2d(grid, pts, INTERP_EPSILON), num_nodes = num_nodes)
+            self.record('interp2d_operator', lambda: interp2d_operator(pts, 8, 8, INTERP_EPSILON), num_nodes = num_nodes)
+            self.record('apply_interp2d', lambda: apply_interp2d(grid, op), num_nodes = num_nodes)
+
+    def forward_backward(self):
+        torch.manual_seed(0)
+        models = {'SSENet': SSENet(dtype = self.dtype),
+                  'SSENetCustom(xyd+global)': SSENetCustom((True, False, True), dtype = self.dtype)}
+        for n in self.mesh_sizes:
+            dataset = self.dataset(n)
+            for b in self.batch_sizes:
+                data = get_batch(dataset, list(range(b)))
+                num_nodes = len(data.x)
+                for name, model in models.items():
+                    def step():
+                        model.zero_grad()
+                        batch_loss(model(data), data).backward()
+                    self.record('predict', lambda: predict(model, data), model = name,
+                                mesh_size = n, batch_size = b, num_nodes = num_nodes)
+                    self.record('forward_backward', step, model = name,
+                                mesh_size = n, batch_size = b, num_nodes = num_nodes)
+
+    def chunked_inference(self):
+        torch.manual_seed(0)
+        model = SSENet(dtype = self.dtype)
+        for n in self.mesh_sizes:
+            data = self.dataset(n)[0]
+            for chunk_size in (4096, 65536):
+                self.record('predict_chunked', lambda: predict_chunked(model, data, chunk_size),
+                            mesh_size = n, chunk_size = chunk_size, num_nodes = len(data.x))
+
+    def loading(self):
+        for n in self.mesh_sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, 'synthetic.mat')
+                write_synthetic_mat(filename, self.num_graphs, n)
+                processed = os.path.join(tmp, 'processed')
+                convert_matlab_dataset(filename, processed, dtype = self.dtype)
+                params = dict(mesh_size = n, num_graphs = self.num_graphs)
+                self.record('load_matlab_dataset', lambda: load_matlab_dataset(filename, dtype = self.dtype), **params)
+                self.record('convert_matlab_dataset',
+                            lambda: convert_matlab_dataset(filename, os.path.join(tmp, 'converted'), dtype = self.dtype),
+                            **params)
+                self.record('processed_dataset_iterate', lambda: list(load_processed_dataset(processed)), **params)
+                os.makedirs(os.path.join(tmp, 'spill'))
+                streaming = StreamingMatDataset(filename, dtype = self.dtype, spill_dir = os.path.join(tmp, 'spill'))
+                self.record('streaming_dataset_iterate', lambda: list(streaming), **params)
+                streaming.close()
+
+    def evaluation(self):
+        torch.manual_seed(0)
+        model = SSENet(dtype = self.dtype)
+        for n in self.mesh_sizes:
+            dataset = self.dataset(n)
+            for b in self.batch_sizes:
+                self.record('evaluate_dataset', lambda: evaluate_dataset(model, dataset, max_nodes = b * n),
+                            mesh_size = n, max_nodes = b * n, num_graphs = len(dataset))
+
+    BENCHMARKS = ('sse_construction', 'cvec', 'interp', 'forward_backward', 'chunked_inference', 'loading', 'evaluation')
+
+    def run(self, only = None):
+        for name in only or self.BENCHMARKS:
+            getattr(self, name)()
+        return self.results
+
+
+def environment():
+    # What the results were measured with, so that results files can be told apart
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': sys.version.split()[0], 'numpy': np.__version__,
+            'torch': torch.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def result_key(result):
+    # Identifies a benchmark case across results files: its name and parameters
+    return json.dumps({k: v for k, v in result.items() if not k.endswith('_ms') and k != 'repeat'}, sort_keys = True)
+
+
+def compare_results(old, new, threshold = 1.1):
+    '''
+    compare_results: Prints the change in median time of every benchmark case found in two results files
+
+    old, new - The results, as loaded from the JSON files
+    threshold - Cases that got slower by more than this factor are flagged as regressions
+
+    Returns - The list of (case, old median, new median) of the regressions
+    '''
+    before = {result_key(r): r['median_ms'] for r in old['results']}
+    regressions = []
+    print(f"\nCompared with {old['environment'].get('commit')} ({old['environment'].get('date')}):")
+    for r in new['results']:
+        key = result_key(r)
+        if key not in before:
+            continue
+        ratio = r['median_ms'] / before[key]
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- regression'
+            regressions.append((key, before[key], r['median_ms']))
+        print(f"{key:90s} {before[key]:10.3f} -> {r['median_ms']:10.3f} ms ({ratio:5.2f}x){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the prediction pipeline on synthetic geometries")
+    parser.add_argument('--mesh-sizes', type = int, nargs = '+', default = [1000, 5000, 20000])
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [1, 4, 16])
+    parser.add_argument('--num-graphs', type = int, default = 32, help = "Dataset size for loading and evaluation")
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--only', nargs = '+', choices = Suite.BENCHMARKS)
+    parser.add_argument('--float', action = 'store_true', help = "Use float32 instead of float64")
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--compare', help = "An earlier results file to compare with")
+    args = parser.parse_args()
+
+    suite = Suite(args.mesh_sizes, args.batch_sizes, args.num_graphs, args.repeat,
+                  torch.float if args.float else torch.double)
+    results = {'version': RESULTS_VERSION, 'environment': environment(),
+               'config': {'mesh_sizes': args.mesh_sizes, 'batch_sizes': args.batch_sizes,
+                          'num_graphs': args.num_graphs, 'dtype': 'float32' if args.float else 'float64'},
+               'results': suite.run(args.only)}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 1)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
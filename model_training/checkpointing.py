@@ -0,0 +1,133 @@
+'''
+Checkpoints of training state, written on a background thread
+
+train_model(..., checkpoint_dir = 'checkpoints') saves the model, the optimizer, the random number generator
+states and the loss histories every few epochs, and train_model(..., resume = 'checkpoints') continues from
+the latest checkpoint with the same results as an uninterrupted run. The training thread only copies the
+state; serializing and writing it happen on a writer thread, and every file is written under a temporary
+name and then renamed, so a crash never leaves a partial checkpoint behind.
+'''
+import os
+import re
+import copy
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_(\d+)\.pt$')
+
+
+def checkpoint_name(epoch):
+    return f'checkpoint_{epoch:05d}.pt'
+
+
+def list_checkpoints(dirname):
+    # The checkpoint files in a directory, oldest (lowest epoch) first
+    if not os.path.isdir(dirname):
+        return []
+    found = sorted((int(m.group(1)), name) for name in os.listdir(dirname) for m in [CHECKPOINT_PATTERN.match(name)] if m)
+    return [os.path.join(dirname, name) for _, name in found]
+
+
+def latest_checkpoint(dirname):
+    # The newest checkpoint in a directory, or None
+    checkpoints = list_checkpoints(dirname)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path):
+    '''
+    load_checkpoint: Loads a checkpoint written by train_model()
+
+    path - A checkpoint file, or a directory of them (the latest is loaded)
+
+    Returns - The state dictionary
+    '''
+    if os.path.isdir(path):
+        filename = latest_checkpoint(path)
+        if filename is None:
+            raise FileNotFoundError(f"No checkpoints in '{path}'")
+        path = filename
+    return torch.load(path, weights_only = False)
+
+
+def rng_state():
+    # The states of the random number generators that training draws from
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+
+
+class CheckpointWriter:
+    '''
+    This class writes checkpoints to a directory on a background thread
+
+    dirname - The directory (created if needed)
+    keep - The number of most recent checkpoints to keep (at least 1; older ones are deleted), or None to keep all
+
+    save() copies the state and returns; if the writer is still busy with earlier checkpoints, it waits for
+    one of them to finish, so at most two copies are held in memory. Errors of the writer are raised by the
+    next save() or by close()
+    '''
+    def __init__(self, dirname, keep = 3):
+        if keep is not None and keep < 1:
+            raise ValueError(f"keep must be None or at least 1, got {keep}")
+        self.dirname = dirname
+        self.keep = keep
+        self.error = None
+        os.makedirs(dirname, exist_ok = True)
+        self.queue = queue.Queue(maxsize = 1)
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def save(self, epoch, state):
+        '''
+        save: Queues a checkpoint for writing
+
+        epoch - The epoch number, which names the file (see checkpoint_name)
+        state - The state to save; tensors are copied before save() returns
+        '''
+        self._raise_error()
+        self.queue.put((epoch, copy.deepcopy(state)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, epoch, state):
+        filename = os.path.join(self.dirname, checkpoint_name(epoch))
+        # A temporary name of this process's own, in case several write to the same directory
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+        if self.keep is not None:
+            for old in list_checkpoints(self.dirname)[:-self.keep]:
+                os.remove(old)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"Writing a checkpoint to '{self.dirname}' failed") from error
+
+    def close(self):
+        # Waits for the queued checkpoints to be written
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
@@ -1,24 +1,91 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+from collections import deque
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
 import scipy
 from scipy import io
 import torch
+import torch.nn.functional as F
 
 from spectral_np_utils import *
+from pytorch_utils import *
 import random
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 class DataPt:
     '''
     This class holds data for a single geometry
     x - The x and y coordinates at each node
     y - The scalar field values at each node
     sdf - An NxN array of SDF values sampled across the geometry
+    elem - The (0-based) int32 node indices of each mesh element, e.g. for mesh_laplacian()
+           (only kept by load_matlab_dataset() if asked for, see keep_elem)
+    interp - Dictionary of precomputed interpolation operators at the nodes, keyed by grid size (see add_interp_operators)
+    pooled - Dictionary of average-pooled 1x2xMxM sdf tensors, keyed by pool size (see add_pooled_sdfs)
+    
+    Once loaded, sdf is a 1x2xNxN tensor of the SDF and the geometry (SDF > 0).
+    Only the SDF channel needs to be stored: if 'sdf' is set to a 1x1xNxN tensor,
+    the geometry channel is derived from it whenever 'sdf' is read.
+    sse is stored once per geometry (1xk), not once per node.
     '''
+    __slots__ = ('x', 'y', 's', 'sse', '_sdf', 'elem', 'interp', 'pooled', 'batch', 'num_graphs')
+
     def __init__(self, x = None, y = None, sdf = None):
         self.x = x
         self.y = y
         self.sdf = sdf
+        self.s = None
+        self.sse = None
+        self.elem = None
+        self.interp = None
+        self.pooled = None
+        self.batch = None
+        self.num_graphs = 1
+
+    def to(self, dtype):
+        '''
+        to: Returns a copy of this DataPt with its floating point tensors converted to 'dtype'
+        (tensors that are already of type 'dtype' are shared, not copied)
+        '''
+        data = DataPt()
+        for name in self.__slots__:
+            setattr(data, name, _to_dtype(getattr(self, name), dtype))
+        return data
+
+    @property
+    def sdf(self):
+        sdf = self._sdf
+        if torch.is_tensor(sdf) and sdf.dim() == 4 and sdf.shape[1] == 1:
+            return torch.cat((sdf, (sdf > 0).to(sdf.dtype)), 1)
+        return sdf
+
+    @sdf.setter
+    def sdf(self, sdf):
+        self._sdf = sdf
+
+
+def _to_dtype(val, dtype):
+    # Converts the floating point tensors of a DataPt field, including those in the 'pooled' and 'interp'
+    # dictionaries (pooled SDFs, and (indices, weights) interpolation operators)
+    if torch.is_tensor(val):
+        return val.to(dtype) if val.is_floating_point() else val
+    if isinstance(val, dict):
+        return {key: _to_dtype(v, dtype) for key, v in val.items()}
+    if isinstance(val, tuple):
+        return tuple(_to_dtype(v, dtype) for v in val)
+    return val
+
 
-        
 def get_graph(mat,index):
     '''
     get_graph: Reads a single data point from already-loaded matlab data
@@ -31,20 +98,81 @@ def get_graph(mat,index):
     '''
     
     nodes = mat['nodes'][index,0].T
-    elems = mat['elem'][index,0].T-1
+    elems = (mat['elem'][index,0].T-1).astype(np.int32)
     stress = mat['stress'][index,0]
     dt = mat['dt'][index,0]
     sdf = mat['sdf'][index][0].T
     data = DataPt(x=np.concatenate((nodes,dt),axis=1), y=stress, sdf=sdf)
+    data.elem = elems
     return data
 
 
-def load_matlab_dataset(filename, scale = 10000):
+def add_interp_operators(data, sizes):
+    '''
+    add_interp_operators: Precomputes the operators that interpolate feature maps at a geometry's nodes
+    Node coordinates never change, so this replaces the index and weight computations of every forward pass
+    
+    data - The DataPt (with its x tensor already set)
+    sizes - The (rows, columns) sizes of the feature maps, e.g. ((8, 8),) for 64x64 SDFs pooled by 8
+    '''
+    data.interp = {tuple(size): interp2d_operator(data.x, size[0], size[1], INTERP_EPSILON) for size in sizes}
+
+
+def add_pooled_sdfs(data, pool_sizes):
+    '''
+    add_pooled_sdfs: Precomputes the average-pooled sdf tensors used by the models
+    Pooling has no parameters, so its result can be computed once per geometry
+    
+    data - The DataPt (with its sdf tensor already set)
+    pool_sizes - The pool sizes to compute, e.g. (8,) for the default models
+    '''
+    sdf = data.sdf
+    data.pooled = {p: F.avg_pool2d(sdf, p, stride=p) for p in pool_sizes}
+
+
+def prepare_datapt(data, c, scale = 10000, dtype = torch.double, interp_sizes = ((8, 8),),
+                   pool_sizes = (8,), keep_sdf = True, keep_elem = False):
+    '''
+    prepare_datapt: Converts a DataPt read by get_graph() into the tensors used by the models (in place)
+    
+    data - The DataPt, with x = [x, y, node SDF] at each node, y = the scalar field (or None) and sdf = the NxN SDF
+    c - The SSE coefficient vector of 'sdf'
+    scale, dtype, interp_sizes, pool_sizes, keep_sdf, keep_elem - See load_matlab_dataset
+    '''
+    # Values are computed in double precision first, then rounded to 'dtype'
+    data.s = (torch.tensor(data.x[:,2])[:,None] * 10).to(dtype)
+    data.x = torch.tensor(data.x[:,:2]).to(dtype)
+    data.sse = torch.tensor(c[None, :]).to(dtype)
+    # The geometry channel (sdf > 0) is derived by DataPt when needed
+    data.sdf = (torch.tensor(data.sdf[None, None, :, :],dtype=torch.double) * 10).to(dtype)
+    if data.y is not None:
+        data.y = (torch.tensor(data.y) / scale).to(dtype)
+    add_interp_operators(data, interp_sizes)
+    add_pooled_sdfs(data, pool_sizes)
+    if not keep_sdf:
+        data.sdf = None
+    data.elem = np.asarray(data.elem, dtype=np.int32) if keep_elem and data.elem is not None else None
+    return data
+
+
+SSE_CHUNK_SIZE = 1024 # The number of SDFs load_matlab_dataset() stacks and encodes at a time
+
+
+def load_matlab_dataset(filename, scale = 10000, dtype = torch.double, interp_sizes = ((8, 8),),
+                        pool_sizes = (8,), keep_sdf = True, keep_elem = False):
     '''
     load_matlab_dataset: Loads a scalar field dataset from a .mat file
     
     filename - The .mat dataset consisting of meshes, the scalar field and SDF at each node, and an SDF array
     scale - The number to divide each scalar field value by, defaults to 10000
+    dtype - The floating point type of the tensors, defaults to torch.double (use torch.float for float32)
+    interp_sizes - The feature map sizes to precompute interpolation operators for (see add_interp_operators),
+                   defaults to the 8x8 maps of the default models
+    pool_sizes - The pool sizes to precompute pooled SDFs for (see add_pooled_sdfs), defaults to that of the default models
+    keep_sdf - If False, the full-resolution sdf is discarded once pooled, to save memory.
+               The dataset can then only be used by models whose pool size is in 'pool_sizes'
+    keep_elem - If True, each DataPt keeps its mesh elements ('elem'), e.g. for mesh_laplacian().
+                Nothing in training or evaluation uses them, so they are discarded by default
     
     Returns - The dataset as a list of DataPt objects
     
@@ -56,29 +184,392 @@ def load_matlab_dataset(filename, scale = 10000):
         dataset.append(data)
 
     sse = SSE(k = 50)
-    for data in dataset:
-        c = sse.cvec(data.sdf)
-        n = np.shape(data.x)[0]
-        cmat = np.tile(c,(n,1))
-        data.x = np.concatenate((data.x, cmat),1)
-
-    for data in dataset:
-        c = sse.cvec(data.sdf)
-        n = np.shape(data.x)[0]
-        cmat = np.tile(c,(n,1))
-
-        data.s = torch.tensor(data.x[:,2])[:,None] * 10
-        data.x = torch.tensor(data.x[:,:2])
-        geom = (data.sdf > 0)
-        data.sse = torch.tensor(cmat)
-        sdf = torch.tensor(data.sdf[None, None, :, :],dtype=torch.double) * 10
-        geom = torch.tensor(geom[None, None, :, :],dtype=torch.double)
-        data.sdf = torch.cat((sdf,geom), 1)
-        data.y = torch.tensor(data.y) / scale
+    # Encoded a chunk at a time, so that only one chunk of the SDFs is ever stacked into a copy
+    for start in range(0, len(dataset), SSE_CHUNK_SIZE):
+        chunk = dataset[start:start+SSE_CHUNK_SIZE]
+        cvecs = sse.cvec_batch(np.stack([data.sdf for data in chunk]))
+        for data, c in zip(chunk, cvecs):
+            prepare_datapt(data, c, scale, dtype, interp_sizes, pool_sizes, keep_sdf, keep_elem)
         
     return dataset
 
 
+PROCESSED_FORMAT_VERSION = 3
+PROCESSED_ARRAYS = ('x', 's', 'y', 'offsets', 'sse')
+
+
+def save_processed_dataset(dataset, dirname):
+    '''
+    save_processed_dataset: Writes an already-loaded dataset to a directory of flat .npy arrays
+    that can be memory-mapped by load_processed_dataset()
+    
+    dataset - The list of DataPt objects, as returned by load_matlab_dataset()
+    dirname - The directory to write to (created if it does not exist)
+    
+    The directory holds:
+    - x, s, y: The node coordinates, node SDF values and scalar field of all geometries, concatenated
+    - offsets: CSR-style offsets, the nodes of geometry i are rows offsets[i] to offsets[i+1]
+    - sdf: (N, 1, n, n) array of SDF grids (the geometry channel is derived on load),
+      unless the dataset was loaded with keep_sdf = False
+    - sse: (N, k) array of spectral shape encodings
+    - pooled_<p>: (N, 2, n/p, n/p) arrays of pooled SDFs, for the pool sizes p the dataset has precomputed
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    counts = [len(data.x) for data in dataset]
+    arrays = {
+        'x': torch.cat([data.x for data in dataset]).numpy(),
+        's': torch.cat([data.s for data in dataset]).numpy(),
+        'y': torch.cat([data.y for data in dataset]).numpy(),
+        'offsets': np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+        'sse': torch.stack([data.sse[0] for data in dataset]).numpy(),
+    }
+    has_sdf = all(data.sdf is not None for data in dataset)
+    if has_sdf:
+        arrays['sdf'] = torch.cat([data.sdf[:, :1] for data in dataset]).numpy()
+    pool_sizes = sorted(dataset[0].pooled or ())
+    for p in pool_sizes:
+        arrays[f'pooled_{p}'] = torch.cat([data.pooled[p] for data in dataset]).numpy()
+    for name, arr in arrays.items():
+        np.save(os.path.join(dirname, name + '.npy'), np.ascontiguousarray(arr))
+    with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+        json.dump({'version': PROCESSED_FORMAT_VERSION, 'num_graphs': len(dataset),
+                   'has_sdf': has_sdf, 'pool_sizes': pool_sizes}, f)
+
+
+def convert_matlab_dataset(filename, dirname, scale = 10000, dtype = torch.double):
+    '''
+    convert_matlab_dataset: One-time conversion of a .mat dataset to the processed on-disk format
+    
+    filename - The .mat dataset (see load_matlab_dataset)
+    dirname - The directory to write the processed dataset to
+    scale - The number to divide each scalar field value by, defaults to 10000
+    dtype - The floating point type to store, torch.double (default) or torch.float
+    '''
+    save_processed_dataset(load_matlab_dataset(filename, scale, dtype), dirname)
+
+
+class ProcessedDataset:
+    '''
+    This class gives list-like access to a dataset written by save_processed_dataset()
+    The arrays are memory-mapped, and each DataPt is built on request from views into them,
+    so nothing is read from disk until it is used and processes share the same pages
+    
+    dirname - The directory of the processed dataset
+    interp_sizes - The feature map sizes to compute interpolation operators for when a DataPt is created
+    '''
+    def __init__(self, dirname, interp_sizes = ((8, 8),)):
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != PROCESSED_FORMAT_VERSION:
+            raise ValueError(f"Processed dataset '{dirname}' has format version {meta['version']}, "
+                             f"expected {PROCESSED_FORMAT_VERSION}; re-run convert_matlab_dataset()")
+        # Copy-on-write mapping: pages are shared until written, and torch accepts the arrays as writable
+        self.pool_sizes = meta['pool_sizes']
+        self.has_sdf = meta['has_sdf']
+        names = list(PROCESSED_ARRAYS) + ['sdf'] * self.has_sdf + [f'pooled_{p}' for p in self.pool_sizes]
+        self.arrays = {name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode='c')
+                       for name in names}
+        self.offsets = np.array(self.arrays['offsets'])
+        self.dirname = dirname
+        self.interp_sizes = interp_sizes
+
+    def __reduce__(self):
+        # Other processes re-open the memory maps (sharing their pages) rather than receiving a copy
+        return (ProcessedDataset, (self.dirname, self.interp_sizes))
+
+    def node_counts(self):
+        '''
+        node_counts: The number of nodes of every data point, read without building the data points
+        '''
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"index {i} out of range for dataset of size {len(self)}")
+        a, b = self.offsets[i], self.offsets[i+1]
+        data = DataPt(x = torch.from_numpy(self.arrays['x'][a:b]),
+                      y = torch.from_numpy(self.arrays['y'][a:b]),
+                      sdf = torch.from_numpy(self.arrays['sdf'][i:i+1]) if self.has_sdf else None)
+        data.s = torch.from_numpy(self.arrays['s'][a:b])
+        data.sse = torch.from_numpy(self.arrays['sse'][i:i+1])
+        data.pooled = {p: torch.from_numpy(self.arrays[f'pooled_{p}'][i:i+1]) for p in self.pool_sizes}
+        add_interp_operators(data, self.interp_sizes)
+        return data
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_processed_dataset(dirname, interp_sizes = ((8, 8),)):
+    '''
+    load_processed_dataset: Memory-maps a dataset written by save_processed_dataset()
+    
+    dirname - The directory of the processed dataset
+    interp_sizes - The feature map sizes to compute interpolation operators for (see add_interp_operators)
+    
+    Returns - A ProcessedDataset, which can be indexed like the list returned by load_matlab_dataset()
+    '''
+    return ProcessedDataset(dirname, interp_sizes)
+
+
+MAT_VARIABLES = ('nodes', 'elem', 'stress', 'dt', 'sdf')
+
+
+class StreamingMatDataset:
+    '''
+    This class gives list-like access to a .mat dataset without loading it all into memory:
+    each DataPt is read and converted (as by load_matlab_dataset) only when it is requested
+    
+    MATLAB v7.3 files are HDF5, and are read one data point at a time (this requires h5py).
+    Older versions can only be read one whole variable at a time, so they are first spilled,
+    a variable at a time, to flat memory-mapped arrays in 'spill_dir', which are then read lazily
+    
+    filename - The .mat dataset (see load_matlab_dataset)
+    scale, dtype, interp_sizes, pool_sizes, keep_sdf, keep_elem - See load_matlab_dataset
+    spill_dir - Directory for the spilled arrays of pre-v7.3 files (optional, defaults to a temporary directory,
+                which close() deletes)
+    
+    Can be used as a context manager, which calls close() on exit
+    '''
+    def __init__(self, filename, scale = 10000, dtype = torch.double, interp_sizes = ((8, 8),),
+                 pool_sizes = (8,), keep_sdf = True, keep_elem = False, spill_dir = None):
+        self.filename = filename
+        self.options = dict(scale = scale, dtype = dtype, interp_sizes = interp_sizes,
+                            pool_sizes = pool_sizes, keep_sdf = keep_sdf, keep_elem = keep_elem)
+        self.spill_dir = spill_dir
+        self.owns_spill_dir = False
+        self.sse = SSE(k = 50)
+        self.lock = threading.Lock()
+        
+        if io.matlab.matfile_version(filename)[0] == 2:
+            if h5py is None:
+                raise ImportError(f"Reading the MATLAB v7.3 file '{filename}' requires h5py")
+            self.file = h5py.File(filename, 'r')
+            self.refs = {name: self.file[name][()].flatten() for name in MAT_VARIABLES}
+            self.num_graphs = len(self.refs['nodes'])
+        else:
+            self.file = None
+            if spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='sse_mat_')
+                self.owns_spill_dir = True
+            self.arrays = {}
+            try:
+                for name in MAT_VARIABLES:
+                    if name != 'elem' or keep_elem:
+                        self.arrays[name] = self._spill(name)
+            except BaseException:
+                self.close()
+                raise
+            self.num_graphs = len(self.arrays['nodes'][1]) - 1
+
+    def _spill(self, name):
+        # Only one variable is in memory at a time; its data points are concatenated into one flat array.
+        # Arrays already spilled to 'spill_dir' (e.g. by another process) are reused
+        flat = os.path.join(self.spill_dir, name + '.npy')
+        offsets_file = os.path.join(self.spill_dir, name + '_offsets.npy')
+        if not (os.path.exists(flat) and os.path.exists(offsets_file)):
+            cells = io.loadmat(self.filename, variable_names=[name])[name].flatten()
+            cells = [_mat_orientation(name, np.asarray(c)) for c in cells]
+            np.save(flat, np.concatenate(cells))
+            np.save(offsets_file, np.concatenate(([0], np.cumsum([len(c) for c in cells]))).astype(np.int64))
+            del cells
+        return np.load(flat, mmap_mode='r'), np.load(offsets_file)
+
+    def _read(self, name, i):
+        # Returns variable 'name' of data point i, oriented as in get_graph()
+        if self.file is not None:
+            with self.lock:
+                # HDF5 stores MATLAB arrays transposed, which is the orientation get_graph() uses,
+                # except for the column vectors
+                val = self.file[self.refs[name][i]][()]
+            return val.T if name in ('stress', 'dt') else val
+        flat, offsets = self.arrays[name]
+        return np.array(flat[offsets[i]:offsets[i+1]])
+
+    def __reduce__(self):
+        # Other processes re-open the file (and reuse any spilled arrays) rather than receiving a copy
+        return (_open_streaming_dataset, (self.filename, self.options, self.spill_dir))
+
+    def node_counts(self):
+        '''
+        node_counts: The number of nodes of every data point, read without reading the data points
+        '''
+        if self.file is not None:
+            with self.lock:
+                return np.array([self.file[ref].shape[0] for ref in self.refs['nodes']])
+        return np.diff(self.arrays['nodes'][1])
+
+    def close(self):
+        # Closes the file, and deletes the spilled arrays if they are in a temporary directory made by this dataset
+        if self.file is not None:
+            self.file.close()
+        if self.owns_spill_dir:
+            self.arrays = {}
+            shutil.rmtree(self.spill_dir, ignore_errors = True)
+            self.owns_spill_dir = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.num_graphs
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"index {i} out of range for dataset of size {len(self)}")
+        nodes, dt, sdf = self._read('nodes', i), self._read('dt', i), self._read('sdf', i)
+        data = DataPt(x=np.concatenate((nodes,dt),axis=1), y=self._read('stress', i), sdf=sdf)
+        if self.options['keep_elem']:
+            data.elem = self._read('elem', i).astype(np.int32) - 1
+        return prepare_datapt(data, self.sse.cvec(sdf), **self.options)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _open_streaming_dataset(filename, options, spill_dir):
+    return StreamingMatDataset(filename, spill_dir = spill_dir, **options)
+
+
+def _mat_orientation(name, val):
+    # The orientation get_graph() uses for each variable of a data point read by scipy.io.loadmat
+    return val if name in ('stress', 'dt') else val.T
+
+
+def load_streaming_dataset(filename, **kwargs):
+    '''
+    load_streaming_dataset: Opens a .mat dataset for reading one data point at a time
+    
+    filename - The .mat dataset (see load_matlab_dataset)
+    kwargs - Options of StreamingMatDataset
+    
+    Returns - A StreamingMatDataset, which can be indexed like the list returned by load_matlab_dataset()
+    '''
+    return StreamingMatDataset(filename, **kwargs)
+
+
+def convert_matlab_dataset_parallel(filename, dirname, scale = 10000, dtype = torch.double, pool_sizes = (8,),
+                                    keep_sdf = True, num_workers = None, spill_dir = None):
+    '''
+    convert_matlab_dataset_parallel: Converts a .mat dataset to the processed on-disk format
+    (see save_processed_dataset) using a pool of processes
+    
+    Every data point is converted independently and written straight into preallocated memory-mapped
+    output arrays, so no results are sent back between processes, and the output is the same for any
+    number of workers
+    
+    filename - The .mat dataset (see load_matlab_dataset)
+    dirname - The directory to write the processed dataset to
+    scale, dtype, pool_sizes, keep_sdf - See load_matlab_dataset (dtype can be torch.double or torch.float)
+    num_workers - The number of processes, defaults to the number of CPUs
+    spill_dir - See StreamingMatDataset (defaults to a temporary directory, deleted after the conversion)
+    '''
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    # A temporary spill directory (see StreamingMatDataset) is deleted once the conversion is done
+    made_spill_dir = spill_dir is None
+    if made_spill_dir:
+        spill_dir = tempfile.mkdtemp(prefix='sse_mat_')
+    try:
+        options = dict(scale = scale, dtype = dtype, pool_sizes = tuple(pool_sizes), keep_sdf = keep_sdf)
+    
+        source = StreamingMatDataset(filename, spill_dir = spill_dir, interp_sizes = (), **options)
+        counts = source.node_counts()
+        first = source[0]
+        source.close()
+    
+        # Preallocate the outputs in the layout of save_processed_dataset()
+        os.makedirs(dirname, exist_ok=True)
+        N, total = len(counts), int(np.sum(counts))
+        np_dtype = first.x.numpy().dtype
+        shapes = {'x': (total, 2), 's': (total, 1), 'y': (total, first.y.shape[1]), 'sse': (N, first.sse.shape[1])}
+        if keep_sdf:
+            shapes['sdf'] = (N, 1, *first.sdf.shape[2:])
+        for p in pool_sizes:
+            shapes[f'pooled_{p}'] = (N, *first.pooled[p].shape[1:])
+        for name, shape in shapes.items():
+            np.lib.format.open_memmap(os.path.join(dirname, name + '.npy'), mode='w+',
+                                      dtype=np_dtype, shape=shape).flush()
+        np.save(os.path.join(dirname, 'offsets.npy'), np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+    
+        bounds = np.linspace(0, N, num_workers + 1).astype(int)
+        chunks = [(filename, dirname, spill_dir, options, bounds[w], bounds[w+1])
+                  for w in range(num_workers) if bounds[w] < bounds[w+1]]
+        # 'spawn' gives each worker its own (HDF5, torch) library state
+        with ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+            list(executor.map(_convert_chunk, chunks))
+    
+        with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+            json.dump({'version': PROCESSED_FORMAT_VERSION, 'num_graphs': N,
+                       'has_sdf': keep_sdf, 'pool_sizes': sorted(pool_sizes)}, f)
+    finally:
+        if made_spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors = True)
+
+
+def _convert_chunk(args):
+    # Worker of convert_matlab_dataset_parallel: converts data points [start, stop) into the output arrays
+    filename, dirname, spill_dir, options, start, stop = args
+    torch.set_num_threads(1)
+    source = StreamingMatDataset(filename, spill_dir = spill_dir, interp_sizes = (), **options)
+    names = ['x', 's', 'y', 'sse'] + ['sdf'] * options['keep_sdf'] + [f'pooled_{p}' for p in options['pool_sizes']]
+    out = {name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r+') for name in names}
+    offsets = np.load(os.path.join(dirname, 'offsets.npy'))
+    for i in range(start, stop):
+        data = source[i]
+        a, b = offsets[i], offsets[i+1]
+        out['x'][a:b] = data.x.numpy()
+        out['s'][a:b] = data.s.numpy()
+        out['y'][a:b] = data.y.numpy()
+        out['sse'][i] = data.sse[0].numpy()
+        if options['keep_sdf']:
+            out['sdf'][i] = data.sdf[0, :1].numpy()
+        for p in options['pool_sizes']:
+            out[f'pooled_{p}'][i] = data.pooled[p][0].numpy()
+    for arr in out.values():
+        arr.flush()
+    source.close()
+
+
+def prefetch(load, items, window = 4, num_threads = 2):
+    '''
+    prefetch: Calls 'load' on each item in order on a background thread pool, keeping up to 'window'
+    items loading ahead of the one being used. Only 'window' loaded items are held in memory at once
+    
+    load - The function that loads an item, e.g. lambda i: dataset[i]
+    items - The items to load
+    window - The number of items loaded ahead, with 0 loading each item only when it is needed
+    num_threads - The number of background threads
+    
+    Returns - A generator of load(item) for each item in 'items'
+    '''
+    items = iter(items)
+    if window <= 0:
+        for item in items:
+            yield load(item)
+        return
+    with ThreadPoolExecutor(max_workers = num_threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(load, item))
+            if len(pending) > window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def get_split_indices(dataset, train_fraction = 0.8, seed = 0):
     '''
     get_split_indices: Given a dataset, randomly generates indices for testing and training
@@ -98,3 +589,70 @@ def get_split_indices(dataset, train_fraction = 0.8, seed = 0):
     idxs_tr = idxs[:int(train_fraction*N)]
     idxs_val = idxs[int(train_fraction*N):]
     return idxs_tr, idxs_val
+
+
+def node_budget_batches(dataset, indices, max_nodes = 8192):
+    '''
+    node_budget_batches: Groups consecutive indices of a dataset into batches of at most 'max_nodes' nodes
+    (a single data point larger than 'max_nodes' gets a batch of its own)
+    Very large batches are slower on CPU once their activations no longer fit in cache,
+    so the number of nodes is a better limit than the number of data points
+    
+    dataset - The list of data points (the node counts of a ProcessedDataset or StreamingMatDataset
+              are read with node_counts(), without loading its data points)
+    indices - The indices of 'dataset' to group
+    max_nodes - The largest number of nodes in a batch
+    
+    Returns - A list of lists of indices
+    '''
+    counts = dataset.node_counts() if hasattr(dataset, 'node_counts') else None
+    batches, current, n = [], [], 0
+    for i in indices:
+        size = int(counts[i]) if counts is not None else len(dataset[i].x)
+        if current and n + size > max_nodes:
+            batches.append(current)
+            current, n = [], 0
+        current.append(i)
+        n += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def collate_graphs(datapts):
+    '''
+    collate_graphs: Packs several variable-size geometries into a single batched DataPt
+    
+    datapts - A list of (already loaded) DataPt objects
+    
+    Returns - A DataPt whose node tensors (x, s, y) are concatenated across geometries,
+    whose sse is the stacked Bxk tensor, whose sdf is the stacked Bx2xNxN tensor (if every geometry has one),
+    whose pooled SDFs are stacked likewise, and with two extra fields:
+    - batch: For every node, the index of the geometry (0 to B-1) it belongs to
+    - num_graphs: The number of geometries B in the batch
+    
+    '''
+    batch = DataPt(x = torch.cat([data.x for data in datapts], 0))
+    if all(data.y is not None for data in datapts):
+        batch.y = torch.cat([data.y for data in datapts], 0)
+    if all(data.sdf is not None for data in datapts):
+        batch.sdf = torch.cat([data.sdf for data in datapts], 0)
+    batch.s = torch.cat([data.s for data in datapts], 0)
+    batch.sse = torch.cat([data.sse for data in datapts], 0)
+    counts = torch.tensor([data.x.shape[0] for data in datapts])
+    batch.batch = torch.repeat_interleave(torch.arange(len(datapts)), counts)
+    batch.num_graphs = len(datapts)
+    
+    pool_sizes = set.intersection(*[set(data.pooled or ()) for data in datapts])
+    if pool_sizes:
+        batch.pooled = {p: torch.cat([data.pooled[p] for data in datapts], 0) for p in pool_sizes}
+    
+    # Interpolation operators index the stacked feature maps, so graph b's indices are offset by b*rows*columns
+    sizes = set.intersection(*[set(data.interp or ()) for data in datapts])
+    if sizes:
+        batch.interp = {}
+        for size in sizes:
+            ops = [data.interp[size] for data in datapts]
+            batch.interp[size] = (torch.cat([idx + b*size[0]*size[1] for b, (idx, _) in enumerate(ops)]),
+                                  torch.cat([w for _, w in ops]))
+    return batch
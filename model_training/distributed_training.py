@@ -0,0 +1,107 @@
+'''
+Data-parallel training of SSENet/SSENetCustom models on CPU, across several worker processes
+
+Every worker owns a fixed shard of the training indices and runs train_model() on it, on a copy
+of the model wrapped in DistributedDataParallel: after each backward pass the gradients of all
+workers are averaged (all-reduce over the gloo backend), so every copy takes the same optimizer step.
+One step therefore covers num_workers * batch_size geometries.
+'''
+import os
+import copy
+import socket
+import random
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from models import *
+
+
+def shard_indices(idxs_tr, num_workers):
+    '''
+    shard_indices: Splits the training indices between workers
+
+    Every shard has the same length, so that all workers take the same number of steps
+    (up to num_workers - 1 indices are left out)
+
+    Returns - A list of num_workers lists of indices
+    '''
+    idxs_tr = list(idxs_tr)
+    size = len(idxs_tr) // num_workers
+    if size == 0:
+        raise ValueError(f"Cannot split {len(idxs_tr)} training geometries between {num_workers} workers")
+    return [idxs_tr[rank::num_workers][:size] for rank in range(num_workers)]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _train_worker(rank, num_workers, port, model, dataset, shards, idxs_val, threads_per_worker, seed,
+                  print_progress, kwargs, result_file):
+    torch.set_num_threads(threads_per_worker)
+    dist.init_process_group('gloo', init_method = f'tcp://127.0.0.1:{port}', rank = rank, world_size = num_workers)
+    try:
+        # Every worker draws from the same random sequence, so the validation samples
+        # (and the decisions to stop early) are the same on all of them
+        random.seed(seed)
+        # mp.spawn() passes the model's tensors in shared memory: without a copy, every worker's optimizer
+        # steps would update the same parameters
+        model = copy.deepcopy(model)
+        ddp_model = DistributedDataParallel(model)
+        # train_model() averages each epoch's training loss over the workers' shards
+        _, loss_hist, val_hist, total_time = train_model(ddp_model, dataset, shards[rank], idxs_val,
+                                                         print_progress = print_progress and rank == 0, **kwargs)
+        if rank == 0:
+            torch.save({'state_dict': model.state_dict(), 'loss_hist': [float(v) for v in loss_hist],
+                        'val_hist': val_hist, 'total_time': total_time}, result_file)
+    finally:
+        dist.destroy_process_group()
+
+
+def train_model_distributed(model, dataset, idxs_tr, idxs_val, num_workers = 2, threads_per_worker = 1,
+                            seed = 0, print_progress = True, **kwargs):
+    '''
+    train_model_distributed: Trains a Pytorch model with train_model(), data-parallel across worker processes
+
+    model - the model to train (its weights are updated in place)
+
+    dataset - the data on which to train the model. It is sent to every worker: a ProcessedDataset or
+              StreamingMatDataset is re-opened by each worker instead of being copied
+
+    idxs_tr - the indices of 'dataset' to be used for training data, split between the workers by shard_indices()
+
+    idxs_val - the indices of 'dataset' to be used for validation (every worker validates on the same samples)
+
+    num_workers - The number of worker processes
+
+    threads_per_worker - The number of threads each worker uses for intra-op parallelism
+
+    seed - The seed of Python's random generator in every worker. With one worker, the result is
+           identical to calling random.seed(seed) and then train_model()
+
+    kwargs - Any other arguments of train_model() (epochs, lr, batch_size, val_every, patience, ...).
+             Checkpoints (checkpoint_dir) are written by the first worker only, and hold the state of
+             the unwrapped model, so that 'resume' works both here and with train_model()
+
+    Returns - As train_model(): the model, the training and validation loss histories, and the training time
+    '''
+    dtype = kwargs.pop('dtype', None)
+    if dtype is not None:
+        model = model.to(dtype)
+    shards = shard_indices(idxs_tr, num_workers)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        result_file = os.path.join(tmp, 'result.pt')
+        args = (num_workers, _free_port(), model, dataset, shards, list(idxs_val), threads_per_worker, seed,
+                print_progress, kwargs, result_file)
+        mp.spawn(_train_worker, args = args, nprocs = num_workers, join = True)
+        result = torch.load(result_file, weights_only = False)
+
+    model.load_state_dict(result['state_dict'])
+    return model, result['loss_hist'], result['val_hist'], result['total_time']
@@ -5,6 +5,7 @@ import torch
 
 from data_loading import *
 from pytorch_utils import *
+from models import predict
 
 def get_r2(a, b):
     ''' 
@@ -35,6 +36,7 @@ def adj_r2(a, b, nf=1):
     Returns
     - The adjusted R2 value
     '''
+    N = len(a)
     R2 = get_r2(a, b)
     R2 = 1-(1-R2)*(N-1)/(N-nf-1)
     return R2
@@ -55,7 +57,94 @@ def eval_model(model, data):
 
     return get_r2(gt, pred)
 
-def evaluate_all_data(model, wss, idxs_tr, idxs_val, oss):
+def segment_metrics(pred, gt, batch, num_graphs, nf=1):
+    ''' 
+    segment_metrics: Computes per-graph error metrics for a batch of predictions at once,
+    using the same definitions as get_r2() and adj_r2()
+    
+    pred - Tensor of predicted values at every node
+    gt - Tensor of ground-truth values at every node
+    batch - Tensor with the graph index of every node
+    num_graphs - The number of graphs in the batch
+    nf - The number of features used to make the prediction, for the adjusted R2
+    
+    Returns
+    - Dictionary of arrays with one value per graph: 'num_nodes', 'r2', 'adj_r2', 'mse' and 'max_error'
+    '''
+    pred, gt = pred.reshape(-1).double(), gt.reshape(-1).double()
+    N = torch.bincount(batch, minlength=num_graphs).double()
+    
+    mean = torch.zeros(num_graphs, dtype=torch.double).index_add_(0, batch, pred) / N
+    SS_tot = torch.zeros(num_graphs, dtype=torch.double).index_add_(0, batch, (pred - mean[batch])**2)
+    SS_res = torch.zeros(num_graphs, dtype=torch.double).index_add_(0, batch, (gt - pred)**2)
+    max_error = torch.zeros(num_graphs, dtype=torch.double).scatter_reduce_(0, batch, (gt - pred).abs(), 'amax')
+    
+    R2 = 1 - SS_res/SS_tot
+    return {
+        'num_nodes': N.long().numpy(),
+        'r2': R2.numpy(),
+        'adj_r2': (1 - (1 - R2)*(N - 1)/(N - nf - 1)).numpy(),
+        'mse': (SS_res/N).numpy(),
+        'max_error': max_error.numpy(),
+    }
+
+def evaluate_dataset(model, dataset, indices = None, max_nodes = 8192, nf = 1):
+    ''' 
+    evaluate_dataset: Runs a model on many data points with a few batched forward passes (without autograd),
+    and computes the error metrics of every data point
+    
+    model - The model to evaluate
+    dataset - The data points
+    indices - The indices of 'dataset' to evaluate (optional, defaults to all)
+    max_nodes - The largest number of nodes in each forward pass (see node_budget_batches)
+    nf - The number of features used to make the prediction, for the adjusted R2
+    
+    Returns
+    - Dictionary of arrays with one value per data point, see segment_metrics()
+    '''
+    if indices is None:
+        indices = range(len(dataset))
+    results = []
+    for batch in node_budget_batches(dataset, indices, max_nodes):
+        data = collate_graphs([dataset[i] for i in batch])
+        pred = predict(model, data)
+        results.append(segment_metrics(pred, data.y, data.batch, data.num_graphs, nf))
+    names = ('num_nodes', 'r2', 'adj_r2', 'mse', 'max_error')
+    if not results:
+        return {name: np.array([]) for name in names}
+    return {name: np.concatenate([r[name] for r in results]) for name in names}
+
+def evaluation_table(model, wss, idxs_tr, idxs_val, oss, max_nodes = 8192, nf = 1):
+    ''' 
+    evaluation_table: Evaluates a model on every point in the training, testing, and out-of-sample sets
+    
+    model - The model to evaluate
+    wss - Within sample set data
+    idxs_tr - indices of wss in the training set
+    idxs_val - indices of wss in the validation/testing set
+    oss - Out-of-sample set data
+    max_nodes - The largest number of nodes in each forward pass (see node_budget_batches)
+    nf - The number of features used to make the prediction, for the adjusted R2
+    
+    Returns
+    - A numpy structured array with one row per data point and the fields:
+      'set' ('train', 'test' or 'oss'), 'index' (into wss or oss), 'num_nodes', 'r2', 'adj_r2', 'mse', 'max_error'
+    '''
+    dtype = [('set', 'U5'), ('index', int), ('num_nodes', int),
+             ('r2', float), ('adj_r2', float), ('mse', float), ('max_error', float)]
+    parts = [('train', wss, list(idxs_tr)), ('test', wss, list(idxs_val)), ('oss', oss, list(range(len(oss))))]
+    table = np.zeros(sum(len(idxs) for _, _, idxs in parts), dtype=dtype)
+    start = 0
+    for name, dataset, idxs in parts:
+        rows = table[start:start+len(idxs)]
+        rows['set'] = name
+        rows['index'] = idxs
+        for field, vals in evaluate_dataset(model, dataset, idxs, max_nodes, nf).items():
+            rows[field] = vals
+        start += len(idxs)
+    return table
+
+def evaluate_all_data(model, wss, idxs_tr, idxs_val, oss, max_nodes = 8192):
     ''' 
     evaluate_all_data: Runs a model and computes the R-squared value on every point in the
     training, testing, and out-of-sample sets
@@ -65,33 +154,17 @@ def evaluate_all_data(model, wss, idxs_tr, idxs_val, oss):
     idxs_tr - indices of wss in the training set
     idxs_val - indices of wss in the validation/testing set
     oss - Out-of-sample set data
+    max_nodes - The largest number of nodes in each (batched) forward pass
     
     Returns
     - Array of R2 values on training data
     - Array of R2 values on testing data
     - Array of R2 values on out-of-sample-set data
-    '''
     
-    vals = []
-    for i in idxs_tr:
-        val = eval_model(model,wss[i])
-        vals.append(val)
-    vals1 = np.array(vals)
-
-
-    vals = []
-    for i in idxs_val:
-        val = eval_model(model,wss[i])
-        vals.append(val)
-    vals2 = np.array(vals)
-
-    vals = []
-    for i in range(len(oss)):
-        val = eval_model(model,oss[i])
-        vals.append(val)
-    vals3 = np.array(vals)
-    
-    return vals1, vals2, vals3
+    See evaluation_table() for the other metrics
+    '''
+    table = evaluation_table(model, wss, idxs_tr, idxs_val, oss, max_nodes)
+    return tuple(table['r2'][table['set'] == name] for name in ('train', 'test', 'oss'))
 
 def plot_boxes(train_evals, test_evals, oss_evals, lims = [-0.25, 1], filename = None):
     ''' 
@@ -0,0 +1,271 @@
+'''
+Export of trained SSENet/SSENetCustom models as self-contained CPU inference artifacts
+
+The exported module takes the raw inputs of a geometry (node coordinates, node SDF values and the SDF grid,
+as in a prediction request) and computes everything else itself, including the SSE (a fixed linear map of
+the sampled SDF, stored in the artifact). It is captured either with TorchScript (a .pt file, optionally
+with the MLP dynamically quantized to int8) or with torch.export (a .pt2 file, which can be compiled
+with torch.compile when loaded). Either is loaded by inference_runtime.py, which needs only PyTorch.
+
+    python inference_export.py model.pt model_int8.pt --quantize --report --num-graphs 40
+    python inference_export.py model.pt model.pt2 --report --mat data/stress_vor_o.mat
+'''
+import sys
+import json
+import time
+import copy
+import argparse
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+from scipy import io
+
+from models import *
+from evaluation import get_r2
+from synthetic_data import synthetic_geometry
+import inference_runtime
+
+EXPORT_FORMAT_VERSION = 1
+
+
+class InferenceModule(nn.Module):
+    '''
+    This class is a trained model together with the computation of its inputs from the raw geometry,
+    written so that TorchScript and torch.export can capture it
+
+    model - The trained SSENet or SSENetCustom
+    dtype - The floating point type of the artifact (dynamic quantization needs torch.float)
+    scale - The predictions are multiplied by this, e.g. 10000 to give stresses in the units of the .mat datasets
+            (defaults to 1, the units the model was trained in, as returned by predict())
+
+    forward(nodes, dt, sdf):
+    nodes - (N, 2) tensor of node coordinates
+    dt - (N, 1) tensor of node SDF values
+    sdf - (n, n) SDF grid, laid out as in the DataPts of get_graph() (rows are y)
+    Returns - (N, 1) tensor of predictions
+    '''
+    use_xyd: torch.jit.Final[bool]
+    use_local: torch.jit.Final[bool]
+    use_global: torch.jit.Final[bool]
+    has_node_inputs: torch.jit.Final[bool]
+    scale: torch.jit.Final[float]
+    epsilon: torch.jit.Final[float]
+
+    def __init__(self, model, dtype = torch.float, scale = 1.0):
+        super(InferenceModule, self).__init__()
+        self.use_xyd = bool(getattr(model, 'use_xyd', True))
+        self.use_local = bool(getattr(model, 'use_local', True))
+        self.use_global = bool(getattr(model, 'use_global', True))
+        self.scale = float(scale)
+        self.epsilon = INTERP_EPSILON
+        if self.use_local:
+            self.pool = copy.deepcopy(model.pool)
+            self.conv = copy.deepcopy(model.conv)
+
+        # The first layer is split into its per-node and per-geometry (SSE) columns, as in Net.first_layer
+        first = model.combine.layers[0]
+        w = first.weight.detach()
+        if self.use_global:
+            # Models pickled before graph_inputs existed have the SSE after the coordinates and SDF
+            a, b = model.combine.graph_inputs or (3 * self.use_xyd, 3 * self.use_xyd + model.config['num_sse'])
+        else:
+            a, b = w.shape[1], w.shape[1]
+        self.has_node_inputs = w.shape[1] > b - a
+        self.node_in = nn.Linear(w.shape[1] - (b - a), w.shape[0], bias = not self.use_global)
+        self.node_in.weight.data = torch.cat((w[:, :a], w[:, b:]), 1).clone()
+        if self.use_global:
+            self.graph_in = nn.Linear(b - a, w.shape[0])
+            self.graph_in.weight.data = w[:, a:b].clone()
+            self.graph_in.bias.data = first.bias.detach().clone()
+            sse = SSE(k = b - a)
+            self.register_buffer('xi', torch.tensor(sse.xi, dtype=torch.long))
+            self.register_buffer('yi', torch.tensor(sse.yi, dtype=torch.long))
+            self.register_buffer('Einv', torch.tensor(sse.Einv))
+        else:
+            self.node_in.bias.data = first.bias.detach().clone()
+        self.hidden = copy.deepcopy(model.combine.layers[1:])
+        self.register_buffer('dtype_of', torch.zeros(0)) # Keeps the floating point type, when the layers are quantized
+        self.to(dtype)
+        self.eval()
+
+    def interp(self, grid, pts):
+        # tensor_interp2d(grid, pts, INTERP_EPSILON) for a [values, rows, columns] grid
+        pts = pts.clamp(self.epsilon, 1 - self.epsilon)
+        rows, columns = grid.shape[1], grid.shape[2]
+        grid = torch.transpose(grid, 1, 2)
+        x, y = pts[:, 0] * (columns - 1), pts[:, 1] * (rows - 1)
+        x_i, y_i = torch.floor(x).long(), torch.floor(y).long()
+        x_f, y_f = (x - torch.floor(x)).view(1, -1), (y - torch.floor(y)).view(1, -1)
+        bottom = smoothstep(grid[:, x_i, y_i],     grid[:, x_i + 1, y_i],     x_f)
+        top    = smoothstep(grid[:, x_i, y_i + 1], grid[:, x_i + 1, y_i + 1], x_f)
+        left   = smoothstep(grid[:, x_i, y_i],     grid[:, x_i, y_i + 1],     y_f)
+        right  = smoothstep(grid[:, x_i + 1, y_i], grid[:, x_i + 1, y_i + 1], y_f)
+        return torch.transpose(0.5 * smoothstep(left, right, x_f) + 0.5 * smoothstep(bottom, top, y_f), 0, 1)
+
+    def forward(self, nodes, dt, sdf):
+        dtype = self.dtype_of.dtype
+        nodes = nodes.to(dtype)
+        sdf = sdf.to(dtype)
+        ins = []
+        if self.use_xyd:
+            ins.append(nodes)
+            ins.append(dt.to(dtype).reshape(-1, 1) * 10)
+        if self.use_local:
+            grid = sdf[None, None] * 10
+            grid = torch.cat((grid, (grid > 0).to(dtype)), 1)
+            ins.append(self.interp(self.conv(self.pool(grid))[0], nodes))
+        if self.use_global:
+            sse = torch.matmul(self.Einv.to(dtype), sdf[self.xi][:, self.yi].reshape(-1))[None]
+            graph = self.graph_in(sse)
+            if self.has_node_inputs:
+                x = self.node_in(torch.cat(ins, 1)) + graph
+            else:
+                x = graph.expand(nodes.shape[0], -1)
+        else:
+            x = self.node_in(torch.cat(ins, 1))
+        for layer in self.hidden:
+            x = layer(torch.relu(x))
+        return x * self.scale
+
+
+def export_model(model, filename, quantize = False, dtype = torch.float, scale = 1.0):
+    '''
+    export_model: Writes a trained model as an inference artifact, to be loaded with inference_runtime.load_exported()
+
+    model - The SSENet or SSENetCustom (or the file it was saved to with save_model())
+    filename - The artifact to write: a .pt file is captured with TorchScript (and frozen),
+               a .pt2 file with torch.export
+    quantize - If True, the linear layers of the MLP are dynamically quantized to int8 (TorchScript only)
+    dtype - The floating point type of the artifact
+    scale - The factor the predictions are multiplied by (see InferenceModule)
+
+    Returns - The metadata stored in the artifact
+    '''
+    if isinstance(model, str):
+        model = load_model(model)
+    module = InferenceModule(model, torch.float if quantize else dtype, scale)
+    meta = {'version': EXPORT_FORMAT_VERSION, 'class': type(model).__name__, 'config': model.config,
+            'dtype': str(torch.float if quantize else dtype).replace('torch.', ''), 'quantized': quantize,
+            'scale': scale}
+    extra_files = {inference_runtime.META_FILE: json.dumps(meta)}
+    if filename.endswith('.pt2'):
+        if quantize:
+            raise ValueError("Dynamic quantization is only supported for TorchScript (.pt) artifacts")
+        n = torch.export.Dim('num_nodes')
+        example = (torch.rand(16, 2, dtype=torch.double), torch.rand(16, 1, dtype=torch.double),
+                   torch.rand(64, 64, dtype=torch.double))
+        program = torch.export.export(module, example, dynamic_shapes = ({0: n}, {0: n}, None))
+        torch.export.save(program, filename, extra_files = extra_files)
+        return meta
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # TorchScript and quantized tensors are deprecated in recent PyTorch
+        if quantize:
+            module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype = torch.qint8)
+        script = torch.jit.freeze(torch.jit.script(module))
+        torch.jit.save(script, filename, _extra_files = extra_files)
+    return meta
+
+
+def raw_inputs(data):
+    # The inputs of an exported model from a DataPt in the form returned by get_graph()
+    return np.asarray(data.x[:, :2]), np.asarray(data.x[:, 2:]), np.asarray(data.sdf)
+
+
+def time_geometries(predict_raw, geometries, repeat = 3):
+    # The median latency of one geometry (ms), and the throughput over all of them (geometries/s, nodes/s)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for data in geometries:
+            t = time.perf_counter()
+            predict_raw(data)
+            latencies.append((time.perf_counter() - t) * 1000)
+    total = time.perf_counter() - start
+    num_nodes = sum(len(data.x) for data in geometries)
+    return float(np.median(latencies)), repeat * len(geometries) / total, repeat * num_nodes / total
+
+
+def export_report(model, geometries, artifacts, scale = 10000, repeat = 3):
+    '''
+    export_report: Compares exported artifacts with the eager model, in accuracy and speed, on held-out geometries
+
+    model - The trained SSENet or SSENetCustom
+    geometries - A list of DataPts in the form returned by get_graph() (with y), e.g. from synthetic_geometry()
+    artifacts - Dictionary of name -> ExportedModel (from inference_runtime.load_exported()) of the artifacts
+                to compare, written by export_model() with scale = 1
+    scale - The scale the model was trained with (the ground truth is divided by it)
+    repeat - The number of timed passes over the geometries
+
+    Returns - A list with one dictionary per model (the eager model first): its 'name', the 'median_r2' over the
+              geometries, the 'median_delta_r2' and 'max_delta_r2' of the per-geometry R2 against the eager model,
+              the 'max_abs_diff' of the predictions, the median 'latency_ms' per geometry and the throughput
+              ('geometries_per_s', 'nodes_per_s')
+    '''
+    sse = SSE(k = model.config['num_sse'])
+    cvecs = sse.cvec_batch(np.stack([data.sdf for data in geometries]))
+    prepared = [prepare_datapt(copy.copy(data), c, scale, model_dtype(model)) for data, c in zip(geometries, cvecs)]
+    truth = [data.y.numpy() for data in prepared]
+
+    def eager(data):
+        # From the raw inputs, as the artifacts are timed: including the SSE and the conversion to tensors
+        c = sse.cvec(data.sdf)
+        return predict(model, prepare_datapt(copy.copy(data), c, scale, model_dtype(model))).numpy()
+    variants = [('eager (' + str(model_dtype(model)).replace('torch.', '') + ')', eager)]
+    for name, exported in artifacts.items():
+        variants.append((name, lambda data, exported=exported: exported.predict(*raw_inputs(data))))
+    reference = [predict(model, data).numpy() for data in prepared]
+
+    rows = []
+    for name, predict_raw in variants:
+        preds = [predict_raw(data) for data in geometries]
+        r2 = np.array([get_r2(t, p) for p, t in zip(preds, truth)])
+        delta = r2 - np.array([get_r2(t, p) for p, t in zip(reference, truth)])
+        latency, geometries_per_s, nodes_per_s = time_geometries(predict_raw, geometries, repeat)
+        rows.append({'name': name, 'median_r2': float(np.median(r2)),
+                     'median_delta_r2': float(np.median(np.abs(delta))), 'max_delta_r2': float(np.max(np.abs(delta))),
+                     'max_abs_diff': float(max(np.max(np.abs(p - r)) for p, r in zip(preds, reference))),
+                     'latency_ms': latency, 'geometries_per_s': geometries_per_s, 'nodes_per_s': nodes_per_s})
+    return rows
+
+
+def format_report(rows):
+    # Formats the result of export_report() as a table
+    lines = [f"{'model':32s} {'median R2':>9s} {'|dR2| med':>9s} {'|dR2| max':>9s} {'max |diff|':>10s} "
+             f"{'ms/geom':>8s} {'geom/s':>8s} {'nodes/s':>10s}"]
+    for r in rows:
+        lines.append(f"{r['name'][-32:]:32s} {r['median_r2']:9.4f} {r['median_delta_r2']:9.2e} {r['max_delta_r2']:9.2e} "
+                     f"{r['max_abs_diff']:10.2e} {r['latency_ms']:8.2f} {r['geometries_per_s']:8.1f} {r['nodes_per_s']:10.0f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Export a trained model as an inference artifact")
+    parser.add_argument('model', help = "A model saved with save_model()")
+    parser.add_argument('output', help = "The artifact to write: .pt (TorchScript) or .pt2 (torch.export)")
+    parser.add_argument('--quantize', action = 'store_true', help = "Quantize the MLP to int8 (TorchScript only)")
+    parser.add_argument('--double', action = 'store_true', help = "Export in float64 instead of float32")
+    parser.add_argument('--report', action = 'store_true', help = "Compare the artifact with the eager model")
+    parser.add_argument('--compile', action = 'store_true', help = "Report on the .pt2 artifact compiled with torch.compile")
+    parser.add_argument('--mat', help = "Held-out geometries for the report (synthetic ones by default)")
+    parser.add_argument('--num-graphs', type = int, default = 40)
+    parser.add_argument('--num-nodes', type = int, default = 2000, help = "Nodes per synthetic geometry")
+    parser.add_argument('--scale', type = float, default = 10000, help = "The scale the model was trained with")
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    print(export_model(model, args.output, args.quantize, torch.double if args.double else torch.float))
+    if args.report:
+        if args.mat:
+            mat = io.loadmat(args.mat)
+            geometries = [get_graph(mat, i) for i in range(min(args.num_graphs, len(mat['nodes'])))]
+        else:
+            rng = np.random.RandomState(1)
+            geometries = [synthetic_geometry(rng, args.num_nodes) for _ in range(args.num_graphs)]
+        artifacts = {args.output: inference_runtime.load_exported(args.output, args.compile)}
+        print(format_report(export_report(model, geometries, artifacts, args.scale)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
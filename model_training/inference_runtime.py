@@ -0,0 +1,65 @@
+'''
+Runs models exported by inference_export.py, with only PyTorch and NumPy (none of the training code)
+
+    model = load_exported('model_int8.pt')
+    prediction = model.predict(nodes, dt, sdf) # (N, 2) coordinates, (N, 1) node SDF, (n, n) SDF grid
+'''
+import json
+import warnings
+
+import numpy as np
+import torch
+
+META_FILE = 'meta.json' # The name of the metadata stored in the artifacts
+
+
+class ExportedModel:
+    '''
+    This class wraps a loaded inference artifact
+
+    module - The TorchScript module or the module of the torch.export program
+    meta - The metadata written by export_model(): 'class', 'config', 'dtype', 'quantized', 'scale'
+    '''
+    def __init__(self, module, meta):
+        self.module = module
+        self.meta = meta
+
+    def predict(self, nodes, dt, sdf):
+        '''
+        predict: Predicts the scalar field at the nodes of a geometry
+
+        nodes - (N, 2) array of node coordinates in the unit square
+        dt - (N,) or (N, 1) array of the SDF value at each node
+        sdf - (n, n) array of the SDF sampled over the unit square (rows are y, as in the DataPts of get_graph())
+
+        Returns - (N, 1) array of predictions
+        '''
+        nodes = torch.as_tensor(np.asarray(nodes, dtype=np.float64))
+        dt = torch.as_tensor(np.asarray(dt, dtype=np.float64)).reshape(-1, 1)
+        sdf = torch.as_tensor(np.asarray(sdf, dtype=np.float64))
+        with torch.inference_mode():
+            return self.module(nodes, dt, sdf).double().numpy()
+
+
+def load_exported(filename, compile = False):
+    '''
+    load_exported: Loads an artifact written by inference_export.export_model()
+
+    filename - A .pt (TorchScript) or .pt2 (torch.export) artifact
+    compile - If True, a .pt2 artifact is compiled with torch.compile (the first predictions are then slow)
+
+    Returns - An ExportedModel
+    '''
+    extra_files = {META_FILE: ''}
+    if filename.endswith('.pt2'):
+        program = torch.export.load(filename, extra_files = extra_files)
+        module = program.module()
+        if compile:
+            module = torch.compile(module, dynamic = True)
+    else:
+        if compile:
+            raise ValueError("torch.compile applies to .pt2 artifacts; TorchScript artifacts are already compiled")
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning) # TorchScript is deprecated in recent PyTorch
+            module = torch.jit.load(filename, _extra_files = extra_files)
+    return ExportedModel(module, json.loads(extra_files[META_FILE]))
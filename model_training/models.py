@@ -2,55 +2,165 @@ import numpy as np
 
 import torch
 import torch.nn.functional as F
+import torch.distributed as dist
 from torch import nn, optim
 
 
 from data_loading import *
 from pytorch_utils import *
+from profiling import stage, active_profiler
+from checkpointing import CheckpointWriter, load_checkpoint, rng_state, set_rng_state
 import time
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Net(torch.nn.Module):
-    def __init__(self, dims):
+    '''
+    A multilayer perceptron with ReLU activations
+
+    dims - The number of features of the input, of each hidden layer, and of the output
+    graph_inputs - (Optional) The (start, stop) columns of the input that are constant over each geometry
+                   (the SSE). forward() then takes them once per geometry, and the first layer's product with
+                   them is computed once per geometry and added to every node, instead of once per node
+    '''
+    def __init__(self, dims, graph_inputs = None):
         super(Net, self).__init__()
         self.layers = torch.nn.ModuleList()
         self.dims = dims
+        self.graph_inputs = graph_inputs
         for i in range(len(self.dims)-1):
             self.layers.append(torch.nn.Linear(self.dims[i], self.dims[i+1]))
 
-    def forward(self, x):
-        for i in range(len(self.layers)):
+    def __setstate__(self, state):
+        # Nets pickled before graph_inputs existed take every input column once per node
+        state.setdefault('graph_inputs', None)
+        super(Net, self).__setstate__(state)
+
+    def forward(self, x, graph_x = None, batch = None):
+        '''
+        x - The input, one row per node: all columns, or only the per-node ones if graph_x is given
+        graph_x - (Optional) The per-geometry columns of the input, one row per geometry (see graph_inputs)
+        batch - The geometry of each node, if graph_x has more than one row
+        '''
+        start = 0
+        if graph_x is not None:
+            x = self.first_layer(x, graph_x, batch)
+            start = 1
+            if len(self.layers) > 1:
+                x = F.relu(x)
+        for i in range(start, len(self.layers)):
             x = self.layers[i](x)
             if i+1 < len(self.layers):
                 x = F.relu(x)
         return x
 
+    def first_layer(self, x, graph_x, batch = None):
+        # The first layer, with the weights split into the per-node and per-geometry columns
+        a, b = self.graph_inputs
+        w = self.layers[0].weight
+        out = F.linear(x, torch.cat((w[:, :a], w[:, b:]), 1))
+        graph_out = F.linear(graph_x, w[:, a:b], self.layers[0].bias)
+        if batch is None:
+            return out + graph_out
+        return segment_add_(out, graph_out, batch)
+
+
+def pooled_sdf(model, data):
+    '''
+    pooled_sdf: Applies a model's pooling to the SDF of a geometry (or of a batch of geometries),
+    using the pooled SDF precomputed in data.pooled if there is one for the model's pool size
+    '''
+    pooled = getattr(data, 'pooled', None)
+    if pooled and model.pool.kernel_size in pooled:
+        return pooled[model.pool.kernel_size]
+    if data.sdf is None:
+        raise ValueError(f"No pooled SDF for pool size {model.pool.kernel_size}, and the full SDF was not kept "
+                         "(load the dataset with this size in 'pool_sizes', or with keep_sdf = True)")
+    return model.pool(data.sdf)
+
+
+def local_features(model, data):
+    '''
+    local_features: Applies a model's pooling and convolution to the SDF of a geometry
+    (or of a batch of geometries), and interpolates the result at every node
+    Uses the precomputed interpolation operator in data.interp if there is one for the feature map's size
+    
+    model - A model with 'pool' and 'conv' layers
+    data - A DataPt, or a batched DataPt from collate_graphs()
+    
+    Returns - Tensor with one row of local features per node
+    '''
+    with stage('pool'):
+        sdf0 = pooled_sdf(model, data)
+    with stage('conv'):
+        sdf0 = model.conv(sdf0)
+    with stage('interp'):
+        interp = getattr(data, 'interp', None)
+        if interp and tuple(sdf0.shape[-2:]) in interp:
+            return apply_interp2d(sdf0, interp[tuple(sdf0.shape[-2:])])
+        batch = getattr(data, 'batch', None)
+        if batch is None:
+            return tensor_interp2d(torch.squeeze(sdf0), data.x, INTERP_EPSILON)
+        return tensor_interp2d(sdf0, data.x, INTERP_EPSILON, batch = batch)
+
+
+def node_sse(data):
+    '''
+    node_sse: Broadcasts the per-geometry spectral shape encoding to every node
+    
+    data - A DataPt (with a 1xk sse), or a batched DataPt from collate_graphs() (with a Bxk sse)
+    
+    Returns - Tensor with one row of SSE coefficients per node
+    '''
+    return broadcast_sse(data.sse, data.x.shape[0], getattr(data, 'batch', None))
+
+
+def broadcast_sse(sse, num_nodes, batch = None):
+    # node_sse() for an SSE tensor: one row per node, from one row per geometry
+    if batch is None:
+        return sse.expand(num_nodes, -1)
+    return sse[batch]
+
 
 class SSENet(torch.nn.Module):
-    def __init__(self, num_filters = 16, num_sse = 50, pool_size = 8, kernel_size = 5, mlp_size=(128, 128, 96)):
+    def __init__(self, num_filters = 16, num_sse = 50, pool_size = 8, kernel_size = 5, mlp_size=(128, 128, 96),
+                 dtype = torch.double):
         super(SSENet, self).__init__()
+        self.config = dict(num_filters = num_filters, num_sse = num_sse, pool_size = pool_size,
+                           kernel_size = kernel_size, mlp_size = tuple(mlp_size))
         self.pool = nn.AvgPool2d(pool_size, stride=pool_size)
         self.conv = nn.Conv2d( 2,  num_filters, kernel_size, padding = int((kernel_size-1)/2))       
-        self.combine = Net((3 + num_filters + num_sse, *mlp_size, 1))
-        self = self.double()
+        self.combine = Net((3 + num_filters + num_sse, *mlp_size, 1), graph_inputs = (3, 3 + num_sse))
+        self = self.to(dtype)
+
+    def __setstate__(self, state):
+        # Models pickled with torch.save(model) before the config was kept get it from their layers
+        super(SSENet, self).__setstate__(state)
+        if 'config' not in state:
+            num_filters = self.conv.out_channels
+            self.config = dict(num_filters = num_filters, num_sse = self.combine.dims[0] - 3 - num_filters,
+                               pool_size = self.pool.kernel_size, kernel_size = self.conv.kernel_size[0],
+                               mlp_size = tuple(self.combine.dims[1:-1]))
         
     def forward(self, data):
-        x = data.x
-        s = data.s
-        sse = data.sse
-        sdf0 = self.pool(data.sdf)
-        sdf0 = self.conv(sdf0)
-        x1 = tensor_interp2d(torch.squeeze(sdf0), x, 0.0001)
-        x = torch.cat((x,s,sse,x1),1)
-        x = self.combine(x)
-        return x
+        x1 = local_features(self, data)
+        with stage('mlp'):
+            return self.node_outputs(data.x, data.s, x1, data.sse, getattr(data, 'batch', None))
+    
+    def node_outputs(self, x, s, local, sse, batch = None):
+        # Same as combine(cat((x, s, node_sse(data), x1))), with the SSE's share of the first layer done per geometry
+        if self.combine.graph_inputs is None:
+            return self.combine(torch.cat((x, s, broadcast_sse(sse, len(x), batch), local), 1))
+        x = torch.cat((x,s,local),1)
+        return self.combine(x, sse, batch)
     
     def filters(self, data):
         # Apply convolutional filters and return local feature maps
         x = data.x
         s = data.s
         sse = data.sse
-        sdf0 = self.pool(data.sdf)
+        sdf0 = pooled_sdf(self, data)
         sdf0 = self.conv(sdf0)
         return sdf0
     
@@ -62,8 +172,12 @@ class SSENet(torch.nn.Module):
     
 class SSENetCustom(torch.nn.Module):
     def __init__(self, which_inputs, 
-                 num_filters = 16, num_sse = 50, pool_size = 8, kernel_size = 5, mlp_size=(128, 128, 96)):
+                 num_filters = 16, num_sse = 50, pool_size = 8, kernel_size = 5, mlp_size=(128, 128, 96),
+                 dtype = torch.double):
         super(SSENetCustom, self).__init__()
+        self.config = dict(which_inputs = tuple(bool(u) for u in which_inputs), num_filters = num_filters,
+                           num_sse = num_sse, pool_size = pool_size, kernel_size = kernel_size,
+                           mlp_size = tuple(mlp_size))
         
         self.use_xyd = which_inputs[0]
         self.use_local = which_inputs[1]
@@ -75,36 +189,287 @@ class SSENetCustom(torch.nn.Module):
         
         n_in = 3 * self.use_xyd + num_filters * self.use_local + num_sse * self.use_global
         
-        self.combine = Net((n_in, *mlp_size, 1))
-        self = self.double()
+        graph_inputs = (3 * self.use_xyd, 3 * self.use_xyd + num_sse) if self.use_global else None
+        self.combine = Net((n_in, *mlp_size, 1), graph_inputs = graph_inputs)
+        self = self.to(dtype)
+
+    def __setstate__(self, state):
+        # As SSENet.__setstate__; the sizes of the inputs not in use are left at their defaults
+        super(SSENetCustom, self).__setstate__(state)
+        if 'config' not in state:
+            num_filters = self.conv.out_channels if self.use_local else 16
+            num_sse = self.combine.dims[0] - 3 * self.use_xyd - num_filters * self.use_local if self.use_global else 50
+            self.config = dict(which_inputs = (bool(self.use_xyd), bool(self.use_local), bool(self.use_global)),
+                               num_filters = num_filters, num_sse = num_sse,
+                               pool_size = self.pool.kernel_size if self.use_local else 8,
+                               kernel_size = self.conv.kernel_size[0] if self.use_local else 5,
+                               mlp_size = tuple(self.combine.dims[1:-1]))
         
     def forward(self, data):
-        x = data.x
+        x1 = local_features(self, data) if self.use_local else None
+        with stage('mlp'):
+            return self.node_outputs(data.x, data.s, x1, data.sse, getattr(data, 'batch', None))
+    
+    def node_outputs(self, x, s, local, sse, batch = None):
+        # The MLP on the inputs in use; the SSE's share of the first layer is computed once per geometry, as in SSENet
         ins = []
         if self.use_xyd:
-            s = data.s
             ins.append(x)
             ins.append(s)
-        if self.use_global:
-            sse = data.sse
-            ins.append(sse)
         if self.use_local:
-            sdf0 = self.pool(data.sdf)
-            sdf0 = self.conv(sdf0)
-            x1 = tensor_interp2d(torch.squeeze(sdf0), x, 0.0001)
-            ins.append(x1)
-            
-        
-        x = torch.cat(ins,1)
-        x = self.combine(x)
-        return x
+            ins.append(local)
+        if not self.use_global:
+            return self.combine(torch.cat(ins,1))
+        if self.combine.graph_inputs is None:
+            # Models pickled before graph_inputs existed: the SSE follows the coordinates and SDF, as in SSENet
+            ins.insert(2 * self.use_xyd, broadcast_sse(sse, len(x), batch))
+            return self.combine(torch.cat(ins,1))
+        x = torch.cat(ins,1) if ins else x.new_zeros(len(x), 0)
+        return self.combine(x, sse, batch)
     
     def count_parameters(self):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
 
 
-def train_model(model, dataset, idxs_tr, idxs_val, epochs = 50, lr = 0.001, print_progress = True):
+MODEL_CLASSES = {'SSENet': SSENet, 'SSENetCustom': SSENetCustom}
+
+
+def save_model(model, filename):
+    '''
+    save_model: Saves a model's class, constructor arguments and weights, to be loaded with load_model()
+    
+    model - The SSENet or SSENetCustom model
+    filename - The file to write (conventionally ending in .pt)
+    '''
+    torch.save({'class': type(model).__name__, 'config': model.config, 'state_dict': model.state_dict()}, filename)
+
+
+def load_model(filename):
+    '''
+    load_model: Loads a model saved with save_model()
+    
+    filename - The saved model file
+    
+    Returns - The model, with the floating point type it was saved in
+    '''
+    saved = torch.load(filename)
+    dtype = next(iter(saved['state_dict'].values())).dtype
+    model = MODEL_CLASSES[saved['class']](**saved['config'], dtype = dtype)
+    model.load_state_dict(saved['state_dict'])
+    return model
+
+
+def batch_loss(out, data, reduction = 'node', weights = None):
+    '''
+    batch_loss: Computes the mean squared error of a prediction on a single or batched DataPt
+    
+    out - The predicted values at every node
+    data - The DataPt (or batched DataPt from collate_graphs()) holding the ground truth
+    reduction - 'node' to average the error over all nodes in the batch,
+                'graph' to average over each geometry first, so that every geometry
+                is weighted equally regardless of its number of nodes
+    weights - (Optional) The weight of each node's squared error, from sample_nodes(),
+              which already account for the reduction
+    
+    Returns - The scalar loss tensor
+    '''
+    if weights is not None:
+        return torch.sum(weights * (out - data.y)**2)
+    batch = getattr(data, 'batch', None)
+    if reduction == 'node' or batch is None:
+        return F.mse_loss(out, data.y)
+    if reduction == 'graph':
+        err = (out - data.y)**2
+        return torch.mean(segment_mean(err, batch, data.num_graphs))
+    raise ValueError(f"Unknown loss reduction '{reduction}', expected 'node' or 'graph'")
+
+
+NODE_WEIGHTINGS = ('uniform', 'stress', 'boundary')
+
+
+def sample_nodes(data, num_samples, weighting = 'uniform', reduction = 'node', generator = None):
+    '''
+    sample_nodes: Draws a random subset of the nodes of each geometry, to train on fewer nodes per step
+    
+    data - The DataPt (or batched DataPt from collate_graphs()), with y
+    num_samples - The number of nodes drawn from each geometry (geometries with no more nodes are kept whole)
+    weighting - How nodes are drawn:
+                'uniform' - Without replacement, all nodes equally likely
+                'stress' - With replacement, half uniformly and half in proportion to |y|
+                'boundary' - With replacement, half uniformly and half in proportion to exp(-|s| / mean |s|),
+                             i.e. favoring nodes near the boundary
+    reduction - The reduction of the loss the weights are for (see batch_loss)
+    generator - (Optional) The torch.Generator to draw with
+    
+    Returns
+    - A DataPt with only the nodes drawn (and their interpolation operators); per-geometry data is shared
+    - Tensor of the weight of each node drawn, such that batch_loss(out, sample, reduction, weights)
+      is an unbiased estimate of the loss over all nodes
+    '''
+    if weighting not in NODE_WEIGHTINGS:
+        raise ValueError(f"Unknown node weighting '{weighting}', expected one of {NODE_WEIGHTINGS}")
+    batch = data.batch
+    total = len(data.x)
+    counts = [total] if batch is None else torch.bincount(batch, minlength=data.num_graphs).tolist()
+    selected, weights = [], []
+    start = 0
+    for count in counts:
+        norm = 1 / total if reduction == 'node' else 1 / (count * len(counts))
+        if count <= num_samples:
+            idx = torch.arange(count)
+            w = torch.full((count,), norm, dtype=torch.double)
+        elif weighting == 'uniform':
+            idx = torch.randperm(count, generator=generator)[:num_samples]
+            w = torch.full((num_samples,), norm * count / num_samples, dtype=torch.double)
+        else:
+            if weighting == 'stress':
+                q = torch.abs(data.y[start:start+count, 0]).double()
+            else:
+                s = torch.abs(data.s[start:start+count, 0]).double()
+                q = torch.exp(-s / torch.clamp(s.mean(), min=1e-12))
+            q = q / q.sum() if q.sum() > 0 else torch.full_like(q, 1 / count)
+            p = 0.5 / count + 0.5 * q
+            idx = torch.multinomial(p, num_samples, replacement=True, generator=generator)
+            w = norm / (num_samples * p[idx])
+        selected.append(idx + start)
+        weights.append(w)
+        start += count
+    selected = torch.cat(selected)
+    
+    sample = DataPt()
+    for name in DataPt.__slots__:
+        setattr(sample, name, getattr(data, name))
+    sample.x, sample.s, sample.y = data.x[selected], data.s[selected], data.y[selected]
+    sample.elem = None
+    if batch is not None:
+        sample.batch = batch[selected]
+    if data.interp:
+        sample.interp = {size: (idx[selected], w[selected]) for size, (idx, w) in data.interp.items()}
+    return sample, torch.cat(weights).to(data.y.dtype).view(-1, 1)
+
+
+def get_batch(dataset, indices, dtype = None):
+    # A single geometry is used as-is; several are packed with collate_graphs()
+    if len(indices) == 1:
+        data = dataset[indices[0]]
+    else:
+        data = collate_graphs([dataset[i] for i in indices])
+    if dtype is not None and data.x.dtype != dtype:
+        data = data.to(dtype)
+    return data
+
+
+def model_dtype(model):
+    # The floating point type of a model's parameters
+    return next(model.parameters()).dtype
+
+
+def predict(model, data, autocast_dtype = None):
+    '''
+    predict: Runs a model for inference only (no autograd), optionally with CPU autocasting
+    
+    model - The model to run
+    data - The DataPt (or batched DataPt) to predict on, converted to the model's dtype if needed
+    autocast_dtype - (Optional) Reduced precision for the convolution and linear layers,
+                     e.g. torch.bfloat16 (the model's parameters must then be float32)
+    
+    Returns - The predicted values at every node, in the model's dtype
+    '''
+    dtype = model_dtype(model)
+    if data.x.dtype != dtype:
+        data = data.to(dtype)
+    with torch.inference_mode():
+        if autocast_dtype is None:
+            return model(data)
+        with torch.autocast('cpu', dtype=autocast_dtype):
+            out = model(data)
+        return out.to(dtype)
+
+
+def predict_chunked(model, data, chunk_size = 65536, num_threads = 1, out = None):
+    '''
+    predict_chunked: Runs a model for inference on a single geometry, a chunk of nodes at a time,
+    so that memory use does not grow with the number of nodes (e.g. for meshes with millions of nodes)
+    
+    The convolution and the SSE's share of the first layer are computed once; the node coordinates
+    are then interpolated in the feature map and passed through the MLP in chunks of 'chunk_size' nodes
+    
+    model - The SSENet or SSENetCustom model
+    data - A single-geometry DataPt with sse and sdf (or pooled); x (N x 2) and s (N x 1) may be tensors
+           or numpy arrays, including memory-mapped ones (np.load(..., mmap_mode = 'r')), read chunk by chunk.
+           Precomputed interpolation operators are not needed (nor used)
+    chunk_size - The number of nodes per chunk
+    num_threads - The number of chunks to compute at once, on a thread pool
+    out - (Optional) Where to write the N predictions: a tensor or numpy array with N rows,
+          e.g. a memory-mapped file from np.lib.format.open_memmap(filename, 'w+', np.float64, (N, 1))
+    
+    Returns - 'out', or a new N x 1 tensor of predictions in the model's dtype
+    '''
+    dtype = model_dtype(model)
+    n = len(data.x)
+    if out is None:
+        out = torch.empty((n, 1), dtype=dtype)
+    with torch.inference_mode():
+        sse = data.sse.to(dtype)
+        fmap = None
+        if getattr(model, 'conv', None) is not None:
+            fmap = torch.squeeze(model.conv(pooled_sdf(model, data).to(dtype)))
+    
+    def rows_of(values, start):
+        # Arrays (possibly read-only memory maps) are copied one chunk at a time
+        values = values[start:start+chunk_size]
+        return (values if torch.is_tensor(values) else torch.from_numpy(np.array(values))).to(dtype)
+    
+    def run(start):
+        # inference_mode is per thread
+        with torch.inference_mode():
+            x = rows_of(data.x, start)
+            s = rows_of(data.s, start).view(-1, 1)
+            local = tensor_interp2d(fmap, x, INTERP_EPSILON) if fmap is not None else None
+            pred = model.node_outputs(x, s, local, sse)
+            rows = out[start:start+len(pred)]
+            rows[...] = pred.reshape(rows.shape) if torch.is_tensor(rows) else pred.numpy().reshape(rows.shape)
+    
+    starts = range(0, n, chunk_size)
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(run, starts))
+    else:
+        for start in starts:
+            run(start)
+    return out
+
+
+def validation_loss(model, batches, reduction = 'node'):
+    '''
+    validation_loss: Computes the loss of a model over a fixed set of (already collated) batches,
+    without autograd
+    
+    model - The model to evaluate
+    batches - A list of DataPts (single or from collate_graphs())
+    reduction - 'node' to average the error over all nodes, or 'graph' to average each geometry's error
+    
+    Returns - The loss, as a float
+    '''
+    total, count = 0.0, 0
+    for data in batches:
+        err = (predict(model, data) - data.y)**2
+        if reduction == 'graph':
+            batch = data.batch if data.batch is not None else torch.zeros(len(err), dtype=torch.long)
+            total += segment_mean(err, batch, data.num_graphs).sum().item()
+            count += data.num_graphs
+        else:
+            total += err.sum().item()
+            count += err.numel()
+    return total / count
+
+
+def train_model(model, dataset, idxs_tr, idxs_val, epochs = 50, lr = 0.001, print_progress = True,
+                batch_size = 1, reduction = 'node', dtype = None, prefetch_window = 0, prefetch_threads = 2,
+                val_every = None, val_subset = None, val_max_nodes = 8192, patience = None, min_delta = 0.0,
+                restore_best = False, node_samples = None, node_weighting = 'uniform',
+                checkpoint_dir = None, checkpoint_every = 1, keep_checkpoints = 3, resume = None):
     ''' 
     train_model: Trains a Pytorch model
     
@@ -120,6 +485,58 @@ def train_model(model, dataset, idxs_tr, idxs_val, epochs = 50, lr = 0.001, prin
     
     lr - The learning rate (for Adam optimizer)
     
+    batch_size - The number of geometries packed into each optimizer step, defaults to 1
+    
+    reduction - How the loss is averaged within a batch: 'node' (over all nodes)
+                or 'graph' (over each geometry, then across geometries)
+    
+    dtype - (Optional) The floating point type to train in, e.g. torch.float. The model is converted,
+            and data of a different type is converted batch by batch (load it in 'dtype' to avoid this)
+    
+    prefetch_window - The number of upcoming steps whose data is loaded ahead on background threads,
+                      for datasets that load on demand (e.g. StreamingMatDataset). Defaults to 0 (no prefetching)
+    
+    prefetch_threads - The number of background threads used for prefetching
+    
+    val_every - How often to validate:
+                None (default) - after every step, on a random validation batch
+                'epoch' - once per epoch, on a fixed validation subset
+                An integer N - every N steps, on a fixed validation subset
+    
+    val_subset - The number of validation geometries in the fixed subset (chosen once, with a fixed seed),
+                 defaults to all of 'idxs_val'
+    
+    val_max_nodes - The largest number of nodes in each batch of the fixed validation subset
+    
+    patience - (Optional) Stop training after this many validations without improvement
+               (with val_every = None, each epoch's average validation loss counts as one validation)
+    
+    min_delta - The decrease in validation loss that counts as an improvement
+    
+    restore_best - If True, the model is returned with the weights that had the lowest validation loss
+    
+    node_samples - (Optional) The number of nodes of each training geometry to compute the loss on at each step,
+                   drawn anew every step, so that the cost of a step does not grow with mesh refinement.
+                   The loss is reweighted to estimate the loss over all nodes (see sample_nodes);
+                   validation always uses all nodes
+    
+    node_weighting - How the nodes are drawn: 'uniform', or 'stress'/'boundary' to favor high-stress nodes
+                     or nodes near the boundary (see sample_nodes)
+    
+    checkpoint_dir - (Optional) A directory to save the training state to (model, optimizer, random number
+                     generators, histories), as checkpoint_<epoch>.pt, written on a background thread
+    
+    checkpoint_every - Save a checkpoint every this many epochs (and after the last epoch)
+    
+    keep_checkpoints - The number of most recent checkpoints to keep (at least 1), or None to keep all
+    
+    resume - (Optional) A checkpoint file, or a directory of them (the latest is used), to continue training from.
+             The model and the other arguments must be the same as in the run that saved it; training then
+             continues up to 'epochs' with the same results as a run that was not interrupted
+    
+    While a profiling.Profiler is active, the time spent in each stage of the steps is recorded,
+    and summarized at the end of every epoch
+    
     Returns:
     - The model
     - A list of average training loss for each epoch
@@ -132,35 +549,142 @@ def train_model(model, dataset, idxs_tr, idxs_val, epochs = 50, lr = 0.001, prin
     
     start_time = time.time() # There are more accurate ways of measuring time, but this should be sufficient
 
+    if dtype is not None:
+        model = model.to(dtype)
+    dtype = model_dtype(model)
+    # Under train_model_distributed() the model is wrapped in DistributedDataParallel: its state is saved
+    # without the wrapper, so that it loads into the plain model, and only the first worker writes checkpoints
+    distributed = isinstance(model, nn.parallel.DistributedDataParallel)
+    core = model.module if distributed else model
+
     opt = optim.Adam(params = model.parameters(),lr=lr)
 
     numpoints = len(dataset)
     indices = range(numpoints)
 
-    for epoch in range(epochs):
-        indices = random.sample(idxs_tr,len(idxs_tr))
-        this_loss = []
-        loss_val = []
-        for k,i in enumerate(indices):
-            data = dataset[i]
+    if val_every is not None:
+        # A separate generator, so that the training order is the same as without a fixed subset
+        val_idxs = list(idxs_val)
+        if val_subset is not None:
+            val_idxs = random.Random(0).sample(val_idxs, min(val_subset, len(val_idxs)))
+        val_batches = [get_batch(dataset, b, dtype) for b in node_budget_batches(dataset, val_idxs, val_max_nodes)]
 
-            out = model(data)
-            loss = F.mse_loss(out, data.y)
-            this_loss.append(loss.item())
+    best = {'loss': np.inf, 'state': None, 'bad': 0}
+    def check_improvement(val):
+        # Keeps the best weights, and returns True once training should stop early
+        if val < best['loss'] - min_delta:
+            best['loss'], best['bad'] = val, 0
+            if restore_best:
+                best['state'] = copy.deepcopy(core.state_dict())
+        else:
+            best['bad'] += 1
+        return patience is not None and best['bad'] >= patience
+
+    step = 0
+    stop = False
+    start_epoch = 0
+    if resume is not None:
+        state = load_checkpoint(resume)
+        core.load_state_dict(state['model'])
+        opt.load_state_dict(state['optimizer'])
+        loss_hist, val_hist = list(state['loss_hist']), list(state['val_hist'])
+        best.update(state['best'])
+        step, stop, start_epoch = state['step'], state['stop'], state['epoch'] + 1
+        start_time -= state['elapsed']
+        set_rng_state(state['rng'])
+        if stop:
+            start_epoch = epochs
+
+    writer = None
+    if checkpoint_dir is not None and (not distributed or dist.get_rank() == 0):
+        writer = CheckpointWriter(checkpoint_dir, keep_checkpoints)
+    try:
+        for epoch in range(start_epoch, epochs):
+            indices = random.sample(idxs_tr,len(idxs_tr))
+            this_loss = []
+            loss_val = []
+            # The validation samples are drawn up front (in the same order as drawing them step by step),
+            # so that they can be prefetched along with the training samples
+            if val_every is None:
+                steps = [(indices[k:k+batch_size], random.sample(idxs_val, min(batch_size, len(idxs_val))))
+                         for k in range(0, len(indices), batch_size)]
+            else:
+                steps = [(indices[k:k+batch_size], None) for k in range(0, len(indices), batch_size)]
+            if node_samples is not None:
+                # The seed of each step's node sample is drawn here, so that it does not depend on prefetching
+                steps = [step + (random.getrandbits(63),) for step in steps]
+            def load(step):
+                with stage('load'):
+                    data, weights = get_batch(dataset, step[0], dtype), None
+                    if node_samples is not None:
+                        data, weights = sample_nodes(data, node_samples, node_weighting, reduction,
+                                                     torch.Generator().manual_seed(step[2]))
+                    return data, weights, step[1] and get_batch(dataset, step[1], dtype)
+            for j, (data, weights, val_data) in enumerate(prefetch(load, steps, prefetch_window, prefetch_threads)):
+                k = j * batch_size
+                step += 1
+
+                with stage('forward'):
+                    out = model(data)
+                with stage('loss'):
+                    loss = batch_loss(out, data, reduction, weights)
+                    this_loss.append(loss.item())
+
+                with stage('backward'):
+                    opt.zero_grad()
+                    loss.backward()
+                with stage('optimizer'):
+                    opt.step()
+
+                with stage('validation'):
+                    if val_every is None:
+                        with torch.no_grad():
+                            loss_val.append(batch_loss(model(val_data), val_data, reduction).item())
+                    elif val_every != 'epoch' and step % val_every == 0:
+                        loss_val.append(validation_loss(model, val_batches, reduction))
+                        stop = check_improvement(loss_val[-1])
+                if print_progress:
+                    print("\r[%-25s]       \r" %("========================="[24-int(25*k/800):]),end="",flush=True)
+                if stop:
+                    break
 
-            opt.zero_grad()
-            loss.backward()
-            opt.step()
+            if val_every == 'epoch':
+                with stage('validation'):
+                    loss_val.append(validation_loss(model, val_batches, reduction))
+                stop = check_improvement(loss_val[-1])
+            elif val_every is None:
+                stop = check_improvement(np.mean(np.array(loss_val)))
 
-            idx = random.sample(idxs_val, 1)[0]
-            loss_val.append(F.mse_loss(model(dataset[idx]), dataset[idx].y).item())
+            epoch_loss = np.mean(np.array(this_loss))
+            if distributed:
+                # Each worker's loss covers its own shard: the history (and so the checkpoints) hold their mean
+                total = torch.tensor(epoch_loss, dtype = torch.double)
+                dist.all_reduce(total)
+                epoch_loss = total.item() / dist.get_world_size()
+            loss_hist.append(epoch_loss)
+            val_hist.append(np.mean(np.array(loss_val)) if loss_val else np.nan)
+            profiler = active_profiler()
+            if profiler is not None:
+                profiler.end_epoch(epoch)
             if print_progress:
-                print("\r[%-25s]       \r" %("========================="[24-int(25*k/800):]),end="",flush=True)
+                print(f"Epoch {epoch} of {epochs}... Train loss: {loss_hist[-1]}      Test loss: {val_hist[-1]}")
+            if writer is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == epochs or stop):
+                # Copied here, written on the writer's thread
+                with stage('checkpoint'):
+                    writer.save(epoch, {'model': core.state_dict(), 'optimizer': opt.state_dict(),
+                                        'loss_hist': loss_hist, 'val_hist': val_hist, 'best': best,
+                                        'step': step, 'stop': stop, 'epoch': epoch, 'rng': rng_state(),
+                                        'elapsed': time.time() - start_time})
+            if stop:
+                if print_progress:
+                    print(f"Stopping early: no improvement in the last {patience} validations")
+                break
+    finally:
+        if writer is not None:
+            writer.close()
 
-        loss_hist.append(np.mean(np.array(this_loss)))
-        val_hist.append(np.mean(np.array(loss_val)))
-        if print_progress:
-            print(f"Epoch {epoch} of {epochs}... Train loss: {loss_hist[-1]}      Test loss: {val_hist[-1]}")
+    if restore_best and best['state'] is not None:
+        core.load_state_dict(best['state'])
 
     end_time = time.time()
     total_time = end_time - start_time
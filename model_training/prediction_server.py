@@ -0,0 +1,278 @@
+'''
+A local prediction service for trained SSENet/SSENetCustom surrogates
+
+Models are loaded from a registry directory of files written by save_model() (<name>.pt).
+Requests carry raw geometry inputs; the SSE, pooled SDFs and interpolation operators are computed
+by the server, and concurrent requests for the same model are grouped into micro-batches.
+
+Run with:
+    python prediction_server.py --registry saved_models --port 8765
+
+Endpoints (JSON over HTTP on localhost):
+    POST /predict - {"model": name, "nodes": [[x, y], ...], "dt": [node SDF, ...], "sdf": 64x64 SDF grid}
+                    returns {"prediction": [...], "latency_ms": ...}
+                    'nodes', 'dt' and 'sdf' are as read by get_graph() (before scaling)
+    GET /models   - the names of the models in the registry
+    GET /stats    - latency and throughput of the requests served so far
+'''
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from models import *
+
+
+class ModelRegistry:
+    '''
+    This class loads models on first use from a directory of files written by save_model()
+
+    dirname - The registry directory, holding one <name>.pt file per model
+    dtype - The floating point type to run the models in, defaults to torch.float
+    '''
+    def __init__(self, dirname, dtype = torch.float):
+        self.dirname = dirname
+        self.dtype = dtype
+        self.models = {}
+
+    def names(self):
+        return sorted(f[:-3] for f in os.listdir(self.dirname) if f.endswith('.pt'))
+
+    def get(self, name):
+        if name not in self.models:
+            filename = os.path.join(self.dirname, name + '.pt')
+            if os.path.basename(name) != name or not os.path.exists(filename):
+                raise KeyError(name)
+            self.models[name] = load_model(filename).to(self.dtype).eval()
+        return self.models[name]
+
+
+class LatencyStats:
+    '''
+    This class records the latency of every request and the size of every micro-batch
+    '''
+    def __init__(self):
+        self.latencies = []
+        self.batch_sizes = []
+        self.num_nodes = 0
+        self.start = None
+        self.end = None
+
+    def record_batch(self, size, num_nodes):
+        self.batch_sizes.append(size)
+        self.num_nodes += num_nodes
+
+    def record_request(self, received, done):
+        if self.start is None:
+            self.start = received
+        self.end = done
+        self.latencies.append(done - received)
+
+    def summary(self):
+        if not self.latencies:
+            return {'requests': 0}
+        ms = np.array(self.latencies) * 1000
+        elapsed = max(self.end - self.start, 1e-9)
+        return {
+            'requests': len(ms),
+            'latency_ms_mean': float(np.mean(ms)),
+            'latency_ms_p50': float(np.percentile(ms, 50)),
+            'latency_ms_p95': float(np.percentile(ms, 95)),
+            'latency_ms_p99': float(np.percentile(ms, 99)),
+            'requests_per_s': len(ms) / elapsed,
+            'nodes_per_s': self.num_nodes / elapsed,
+            'mean_batch_size': float(np.mean(self.batch_sizes)),
+        }
+
+
+class MicroBatcher:
+    '''
+    This class groups concurrent requests for one model into micro-batches
+
+    A batch is run as soon as it holds 'max_batch_size' requests, or once 'max_delay' seconds
+    have passed since its first request arrived, whichever comes first
+
+    model - The model to run
+    max_batch_size - The largest number of geometries run together
+    max_delay - The latency budget (in seconds) spent waiting for a batch to fill
+    executor - The executor that runs the batches, off the event loop
+    stats - The LatencyStats to record batches in
+    '''
+    def __init__(self, model, max_batch_size, max_delay, executor, stats):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self.stats = stats
+        self.sse = SSE(k = model.config['num_sse'])
+        self.dtype = model_dtype(model)
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, data):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((data, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                outs = await loop.run_in_executor(self.executor, self._predict, [data for data, _ in pending])
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), out in zip(pending, outs):
+                if not future.done():
+                    future.set_result(out)
+
+    def _predict(self, raw):
+        # Runs on the executor: encode the whole batch at once, then one forward pass
+        cvecs = self.sse.cvec_batch(np.stack([data.sdf for data in raw]))
+        datapts = [prepare_datapt(data, c, dtype = self.dtype, interp_sizes = (),
+                                  pool_sizes = (self.model.config['pool_size'],), keep_sdf = False)
+                   for data, c in zip(raw, cvecs)]
+        data = collate_graphs(datapts) if len(datapts) > 1 else datapts[0]
+        out = predict(self.model, data).numpy().flatten()
+        self.stats.record_batch(len(datapts), len(out))
+        counts = [len(d.x) for d in datapts]
+        return np.split(out, np.cumsum(counts)[:-1])
+
+
+def parse_inputs(request, n = 64):
+    '''
+    parse_inputs: Checks the raw inputs of a prediction request and packs them into a DataPt
+    (in the form returned by get_graph(), without a scalar field)
+
+    request - The decoded JSON request
+    n - The size of the (n x n) SDF grid the model's SSE is computed from
+    '''
+    for field in ('nodes', 'dt', 'sdf'):
+        if field not in request:
+            raise ValueError(f"missing field '{field}'")
+    nodes = np.asarray(request['nodes'], dtype=np.float64)
+    dt = np.asarray(request['dt'], dtype=np.float64).reshape(-1, 1)
+    sdf = np.asarray(request['sdf'], dtype=np.float64)
+    if nodes.ndim != 2 or nodes.shape[1] != 2:
+        raise ValueError("'nodes' must be a list of [x, y] coordinates")
+    if len(dt) != len(nodes):
+        raise ValueError("'dt' must have one value per node")
+    if sdf.shape != (n, n):
+        raise ValueError(f"'sdf' must be a {n}x{n} grid, got shape {sdf.shape}")
+    return DataPt(x = np.concatenate((nodes, dt), axis=1), sdf = sdf)
+
+
+class PredictionServer:
+    '''
+    This class serves the models of a ModelRegistry over HTTP on localhost
+
+    registry - The ModelRegistry
+    max_batch_size - The largest number of requests run together, defaults to 32
+    max_delay_ms - The latency budget for filling a micro-batch, in milliseconds, defaults to 5
+    host, port - The address to listen on
+    '''
+    def __init__(self, registry, max_batch_size = 32, max_delay_ms = 5, host = '127.0.0.1', port = 8765):
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.stats = LatencyStats()
+        self.batchers = {}
+
+    async def predict(self, request):
+        received = time.perf_counter()
+        name = request['model']
+        if name not in self.batchers:
+            model = self.registry.get(name)
+            self.batchers[name] = MicroBatcher(model, self.max_batch_size, self.max_delay, self.executor, self.stats)
+        batcher = self.batchers[name]
+        # Checked before queueing, so that a malformed request cannot fail the batch it would join
+        out = await batcher.submit(parse_inputs(request, batcher.sse.n))
+        done = time.perf_counter()
+        self.stats.record_request(received, done)
+        return {'prediction': out.tolist(), 'latency_ms': (done - received) * 1000}
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/models':
+            return 200, {'models': self.registry.names()}
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats.summary()
+        if method == 'POST' and path == '/predict':
+            try:
+                request = json.loads(body)
+                if not isinstance(request, dict):
+                    raise ValueError("the request must be a JSON object")
+                name = request.get('model')
+                if name not in self.batchers and name not in self.registry.names():
+                    return 404, {'error': f"unknown model {name!r}"}
+                return 200, await self.predict(request)
+            except (ValueError, TypeError) as e:
+                return 400, {'error': str(e)}
+        return 404, {'error': f"no endpoint {method} {path}"}
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response = await self.route(method, path, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = 400, {'error': f"malformed request: {e}"}
+        except Exception as e:
+            status, response = 500, {'error': f"internal error: {e!r}"}
+        payload = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                     "Connection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Serving models from '{self.registry.dirname}' on http://{self.host}:{self.port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve trained SSENet models on localhost")
+    parser.add_argument('--registry', required = True, help = "Directory of models saved with save_model()")
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--max-batch-size', type = int, default = 32)
+    parser.add_argument('--max-delay-ms', type = float, default = 5)
+    parser.add_argument('--double', action = 'store_true', help = "Run the models in float64 instead of float32")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.registry, torch.double if args.double else torch.float)
+    server = PredictionServer(registry, args.max_batch_size, args.max_delay_ms, port = args.port)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
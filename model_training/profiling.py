@@ -0,0 +1,210 @@
+'''
+Opt-in per-stage profiling of the models and of train_model()
+
+The forward passes of SSENet/SSENetCustom and the steps of train_model() mark their stages
+(pooling, convolution, interpolation, MLP, data loading, backward, optimizer, ...) with stage().
+Nothing is recorded unless a Profiler is active, in which case stage() costs one global lookup.
+
+    with Profiler() as prof:
+        train_model(model, dataset, idxs_tr, idxs_val, epochs = 5)
+    print(format_summary(prof.epochs[-1]))
+    prof.export_chrome_trace('trace.json') # open in chrome://tracing or https://ui.perfetto.dev
+'''
+import json
+import time
+import threading
+
+import torch
+
+_active = None # The Profiler that is recording, if any
+
+
+class _NullStage:
+    # Shared by every stage() call while profiling is off
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'start', 'record')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler.memory:
+            self.record = torch.profiler.record_function('stage:' + self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        self.profiler.events.append((self.name, self.start, end, threading.get_ident()))
+        return False
+
+
+def stage(name):
+    '''
+    stage: Marks a stage of work, as a context manager ("with stage('conv'): ...")
+    Its wall time is recorded by the active Profiler; without one, nothing is done
+    '''
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name)
+
+
+def active_profiler():
+    # The Profiler that is recording, or None
+    return _active
+
+
+class Profiler:
+    '''
+    This class records the stages marked with stage() while it is active (as a context manager)
+
+    memory - If True, the number and size of the tensor allocations in each stage are counted too.
+             This runs torch.profiler alongside, which slows everything down considerably,
+             so the wall times of a memory-profiled run should not be compared with those of another run
+
+    events - A list of (stage name, start ns, end ns, thread id) of every stage, in order of completion
+    epochs - A list of per-epoch summaries (see summarize), one per call of end_epoch()
+    '''
+    def __init__(self, memory = False):
+        self.memory = memory
+        self.events = []
+        self.epochs = []
+        self._epoch_start = 0
+        self._allocations = {}
+        self._torch_profiler = None
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError("A Profiler is already active")
+        self.origin = time.perf_counter_ns()
+        if self.memory:
+            self._start_torch_profiler()
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+        if self.memory:
+            self._stop_torch_profiler()
+        return False
+
+    def _start_torch_profiler(self):
+        self._torch_profiler = torch.profiler.profile(activities = [torch.profiler.ProfilerActivity.CPU],
+                                                      profile_memory = True)
+        self._torch_profiler.__enter__()
+
+    def _stop_torch_profiler(self):
+        # Counts the allocations in each stage (including its nested stages), from the ops recorded so far
+        prof, self._torch_profiler = self._torch_profiler, None
+        prof.__exit__(None, None, None)
+        def allocations(event):
+            count, size = 0, 0
+            for child in event.cpu_children:
+                c, s = allocations(child)
+                count, size = count + c, size + s
+            if not event.name.startswith('stage:') and event.self_cpu_memory_usage > 0:
+                count, size = count + 1, size + event.self_cpu_memory_usage
+            return count, size
+        for event in prof.events():
+            if event.name.startswith('stage:'):
+                count, size = allocations(event)
+                totals = self._allocations.setdefault(event.name[6:], [0, 0])
+                totals[0] += count
+                totals[1] += size
+
+    def summarize(self, events):
+        '''
+        summarize: Aggregates stage events by name
+
+        Returns - Dictionary of stage name -> {'calls', 'total_ms', 'mean_ms', 'max_ms'}
+                  (and 'allocations', 'allocated_bytes' when profiling memory), in order of first completion
+        '''
+        summary = {}
+        for name, start, end, _ in events:
+            ms = (end - start) / 1e6
+            s = summary.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            s['calls'] += 1
+            s['total_ms'] += ms
+            s['max_ms'] = max(s['max_ms'], ms)
+        for s in summary.values():
+            s['mean_ms'] = s['total_ms'] / s['calls']
+        return summary
+
+    def end_epoch(self, epoch = None):
+        '''
+        end_epoch: Closes an epoch, summarizing the stages recorded since the previous one (called by train_model())
+
+        Returns - The summary, which is also appended to 'epochs'
+        '''
+        summary = self.summarize(self.events[self._epoch_start:])
+        self._epoch_start = len(self.events)
+        if self.memory and _active is self:
+            self._stop_torch_profiler()
+            for name, (count, size) in self._allocations.items():
+                if name in summary:
+                    summary[name]['allocations'] = count
+                    summary[name]['allocated_bytes'] = size
+            self._allocations = {}
+            self._start_torch_profiler()
+        self.epochs.append({'epoch': len(self.epochs) if epoch is None else epoch, 'stages': summary})
+        return summary
+
+    def summary(self):
+        # The summary of every stage recorded so far, over all epochs
+        return self.summarize(self.events)
+
+    def export_chrome_trace(self, filename):
+        '''
+        export_chrome_trace: Writes the recorded stages as a timeline in the Chrome trace event format (JSON),
+        one row per thread
+        '''
+        main = threading.main_thread().ident
+        threads = {main: 0}
+        trace = []
+        for name, start, end, thread in self.events:
+            trace.append({'name': name, 'cat': 'stage', 'ph': 'X', 'pid': 0,
+                          'tid': threads.setdefault(thread, len(threads)),
+                          'ts': (start - self.origin) / 1000, 'dur': (end - start) / 1000})
+        for thread, tid in threads.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid,
+                          'args': {'name': 'main' if thread == main else f'thread {tid}'}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'epochs': self.epochs}}, f)
+
+
+def format_summary(summary):
+    '''
+    format_summary: Formats a stage summary (from Profiler.summarize or Profiler.end_epoch) as a table
+
+    Epoch summaries in Profiler.epochs can be passed directly
+    '''
+    if 'stages' in summary:
+        summary = summary['stages']
+    memory = any('allocations' in s for s in summary.values())
+    lines = [f"{'stage':20s} {'calls':>7s} {'total ms':>10s} {'mean ms':>9s} {'max ms':>9s}"
+             + (f" {'allocs':>8s} {'MB':>9s}" if memory else '')]
+    for name, s in sorted(summary.items(), key = lambda item: -item[1]['total_ms']):
+        line = f"{name:20s} {s['calls']:7d} {s['total_ms']:10.2f} {s['mean_ms']:9.3f} {s['max_ms']:9.3f}"
+        if memory:
+            line += f" {s.get('allocations', 0):8d} {s.get('allocated_bytes', 0) / 1e6:9.2f}"
+        lines.append(line)
+    return '\n'.join(lines)
@@ -1,6 +1,10 @@
 import torch
 
 
+# Tolerance used by the models when interpolating feature maps at node coordinates
+INTERP_EPSILON = 0.0001
+
+
 def smoothstep(a0, a1, w):
     ''' 
     smoothstep: Interpolates between two values/arrays/tensors
@@ -37,22 +41,29 @@ def linstep(a0, a1, w):
     return (a1-a0) * w + a0
 
 
-def tensor_interp2d(grid, pts, epsilon = 1e-9):
+def tensor_interp2d(grid, pts, epsilon = 1e-9, batch = None):
     ''' 
     tensor_interp: interpolates a PyTorch tensor at the x-y coordinates requested
     
     grid - the array of values to interpolate, first 2 dimensions are for varying x and y,
            the last dimension has the values
+           If 'batch' is given, grid is instead a stack of B such arrays with shape
+           [B, values, rows, columns]
     pts - A tensor of the x-y coordinates to get interpolated values at.
           0th dimension is points, 1st dimension is [xval, yval]
           The coordinates should be scaled between [0,0] and [1,1], corresponding to corners of 'grid'
     epsilon - A tolerance for making sure values do not exceed the allowable range
+              (with float32 or lower precision, it must be representable next to 1, e.g. 1e-4)
+    batch - (Optional) Tensor with the index into the 0th dimension of 'grid' for each point,
+            so that each point is interpolated in its own graph's grid
     
     Returns - tensor with number of rows equal to number of points, and columns containing the interpolated values
     '''
     
     pts = pts.view(-1,2)
-    pts = pts.clip(min = torch.tensor(epsilon), max = torch.tensor(1 - epsilon))
+    pts = pts.clip(min = epsilon, max = 1 - epsilon)
+    if batch is not None:
+        return _batched_interp2d(grid, pts, batch)
     size = grid.shape
     grid = torch.transpose(grid,1,2)
     if 2 == len(size):
@@ -73,3 +84,121 @@ def tensor_interp2d(grid, pts, epsilon = 1e-9):
     vals = 0.5 * smoothstep(left, right, x_f) + 0.5 * smoothstep(bottom, top, y_f)
 
     return torch.transpose(vals, 0, 1)
+
+
+def _batched_interp2d(grid, pts, batch):
+    # Same interpolation as tensor_interp2d, but every point looks up its own grid
+    _, _, rows, columns = grid.shape
+    grid = grid.permute(0, 3, 2, 1) # [B, columns, rows, values]
+    
+    x, y = ((pts[:,0])*(columns-1)), ((pts[:,1])*(rows-1))
+    
+    x_f, x_i = torch.frac(x).view(-1,1), torch.floor(x).long()
+    y_f, y_i = torch.frac(y).view(-1,1), torch.floor(y).long()
+    
+    bottom = smoothstep(grid[batch, x_i, y_i],     grid[batch, x_i + 1, y_i],     x_f)
+    top    = smoothstep(grid[batch, x_i, y_i + 1], grid[batch, x_i + 1, y_i + 1], x_f)
+    
+    left   = smoothstep(grid[batch, x_i, y_i],     grid[batch, x_i, y_i + 1],     y_f)
+    right  = smoothstep(grid[batch, x_i + 1, y_i], grid[batch, x_i + 1, y_i + 1], y_f)
+    
+    return 0.5 * smoothstep(left, right, x_f) + 0.5 * smoothstep(bottom, top, y_f)
+
+
+def interp2d_operator(pts, rows, columns, epsilon = 1e-9):
+    ''' 
+    interp2d_operator: Precomputes the interpolation done by tensor_interp2d for fixed points and grid size
+    
+    The interpolation is bilinear in the smoothstepped fractions, so each point depends on
+    4 grid values with fixed weights
+    
+    pts - A tensor of the x-y coordinates to interpolate at (see tensor_interp2d)
+    rows, columns - The size of the grid that will be interpolated
+    epsilon - A tolerance for making sure values do not exceed the allowable range
+    
+    Returns
+    - Tensor of shape [points, 4] of indices into the flattened (rows*columns) grid
+    - Tensor of shape [points, 4] of the weights for those grid values
+    '''
+    pts = pts.view(-1,2)
+    pts = pts.clip(min = epsilon, max = 1 - epsilon)
+    x, y = ((pts[:,0])*(columns-1)), ((pts[:,1])*(rows-1))
+    
+    x_f, x_i = torch.frac(x), torch.floor(x).long()
+    y_f, y_i = torch.frac(y), torch.floor(y).long()
+    s_x, s_y = smoothstep(0, 1, x_f), smoothstep(0, 1, y_f)
+    
+    i = y_i * columns + x_i
+    idx = torch.stack((i, i + 1, i + columns, i + columns + 1), 1)
+    weights = torch.stack(((1 - s_x) * (1 - s_y), s_x * (1 - s_y), (1 - s_x) * s_y, s_x * s_y), 1)
+    return idx, weights
+
+
+def apply_interp2d(grid, op):
+    ''' 
+    apply_interp2d: Interpolates a grid with an operator from interp2d_operator()
+    Gradients flow to 'grid'
+    
+    grid - Tensor of values to interpolate, of shape [values, rows, columns], or [B, values, rows, columns]
+           for a batch, in which case the operator's indices must be offset by b*rows*columns for graph b
+    op - The (indices, weights) tuple from interp2d_operator()
+    
+    Returns - tensor with number of rows equal to number of points, and columns containing the interpolated values
+    '''
+    idx, weights = op
+    if 3 == grid.dim():
+        grid = grid[None]
+    flat = grid.permute(0, 2, 3, 1).reshape(-1, grid.shape[1]) # [B*rows*columns, values]
+    n = idx.shape[0]
+    # Rows are in order and the indices of each row are increasing, so the matrix needs no coalescing
+    rows = torch.arange(n).repeat_interleave(idx.shape[1])
+    op = torch.sparse_coo_tensor(torch.stack((rows, idx.flatten())), weights.flatten().to(flat.dtype),
+                                 (n, flat.shape[0]), is_coalesced=True, check_invariants=False)
+    return torch.sparse.mm(op, flat)
+
+
+def segment_mean(vals, batch, num_segments):
+    ''' 
+    segment_mean: Averages the rows of a tensor within each segment (e.g. each graph in a batch)
+    
+    vals - Tensor whose 0th dimension is nodes
+    batch - Tensor with the segment index of each node
+    num_segments - The number of segments
+    
+    Returns - Tensor with one row per segment containing the mean of that segment's rows
+    '''
+    vals = vals.reshape(vals.shape[0], -1)
+    sums = torch.zeros((num_segments, vals.shape[1]), dtype=vals.dtype).index_add_(0, batch, vals)
+    counts = torch.bincount(batch, minlength=num_segments).to(vals.dtype).view(-1,1)
+    return sums / counts
+
+
+class _SegmentAdd(torch.autograd.Function):
+    # Adds a row to every row of its segment in place; the gradient of a segment's row is the sum over the segment
+    @staticmethod
+    def forward(ctx, vals, rows, counts):
+        ctx.mark_dirty(vals)
+        ctx.counts = counts
+        for segment, row in zip(torch.split(vals, counts), rows):
+            segment.add_(row)
+        return vals
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad, torch.stack([segment.sum(0) for segment in torch.split(grad, ctx.counts)]), None
+
+
+def segment_add_(vals, rows, batch):
+    '''
+    segment_add_: Adds one row per segment to every row of that segment, in place
+    (the same as vals + rows[batch], without building the rows[batch] tensor)
+    
+    vals - Tensor whose 0th dimension is nodes, with the nodes of each segment contiguous and in order of segment
+           (as batched by collate_graphs)
+    rows - Tensor with one row per segment
+    batch - Tensor with the segment index of each node
+    
+    Returns - vals
+    '''
+    counts = torch.bincount(batch, minlength=rows.shape[0]).tolist()
+    return _SegmentAdd.apply(vals, rows, counts)
@@ -0,0 +1,232 @@
+'''
+Signed distance fields of 2D shapes bounded by polygons, computed in Python
+
+This replaces the text-file round trip through the calc_sdf executable (dataset_generation/sdf_files):
+boundaries in the format written by output_polyshape.m are read directly, and SDFs are computed for
+whole grids or point sets at once. Distances to all segments are vectorized over chunks of points;
+for boundaries with many segments, a k-d tree over the segments narrows down the candidates per point.
+
+The sign convention is that of polySDF.m: negative inside the material, positive outside.
+(calc_sdf gives the same distances with the opposite sign, except that it signs points whose
+nearest boundary point is a vertex by the boundary alone.)
+
+Run in place of calc_sdf (same arguments and output format):
+    python sdf_utils.py bound.txt out.txt             (64x64 grid over the unit square)
+    python sdf_utils.py bound.txt point.txt out.txt   (at the points of a file written by export_nodes.m)
+'''
+import sys
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+INDEX_MIN_SEGMENTS = 256 # Boundaries with fewer segments are searched by brute force
+CHUNK_ELEMENTS = 2**22 # The number of (point, segment) pairs handled at a time
+
+
+def read_polyshape(filename):
+    '''
+    read_polyshape: Reads the boundaries of a shape written by output_polyshape.m
+
+    Returns - A list of (points, is_hole) tuples, one per boundary, with points an (m, 2) array
+    '''
+    with open(filename) as f:
+        tokens = f.read().split()
+    pos = 1
+    boundaries = []
+    for _ in range(int(tokens[0])):
+        m, is_hole = int(tokens[pos]), bool(int(tokens[pos + 1]))
+        points = np.array(tokens[pos + 2 : pos + 2 + 2 * m], dtype=float).reshape(m, 2)
+        boundaries.append((points, is_hole))
+        pos += 2 + 2 * m
+    return boundaries
+
+
+def write_polyshape(filename, boundaries):
+    '''
+    write_polyshape: Writes boundaries in the format of output_polyshape.m
+
+    boundaries - A list of (points, is_hole) tuples, as from read_polyshape()
+    '''
+    with open(filename, 'w') as f:
+        f.write(f"{len(boundaries)}\n")
+        for points, is_hole in boundaries:
+            f.write(f"{len(points)} {int(is_hole)}\n")
+            np.savetxt(f, points, fmt='%f')
+
+
+def read_points(filename):
+    # Reads a point file as written by export_nodes.m: the number of points, then their coordinates
+    with open(filename) as f:
+        tokens = f.read().split()
+    return np.array(tokens[1 : 1 + 2 * int(tokens[0])], dtype=float).reshape(-1, 2)
+
+
+def signed_area(points):
+    # Positive for counter-clockwise loops
+    x, y = points[:, 0], points[:, 1]
+    return (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+
+class BoundarySDF:
+    '''
+    This class computes the signed distance to a shape bounded by closed polygons
+
+    boundaries - A list of (points, is_hole) tuples, as from read_polyshape(), or a list of loops
+                 (arrays of points) that are already oriented with the material on their left
+                 (outer boundaries counter-clockwise, holes clockwise)
+
+    The sign of a point is taken from the side of its nearest segment (or, if the nearest point is a vertex,
+    from the sum of the normals of the two segments meeting there), so it needs no separate inside test
+    '''
+    def __init__(self, boundaries):
+        loops = []
+        for b in boundaries:
+            if isinstance(b, tuple):
+                points, is_hole = np.asarray(b[0], dtype=float), b[1]
+                # Orient every loop with the material on its left
+                if (signed_area(points) > 0) == is_hole:
+                    points = points[::-1]
+            else:
+                points = np.asarray(b, dtype=float)
+            loops.append(points)
+
+        self.a = np.concatenate(loops)
+        self.b = np.concatenate([np.roll(loop, -1, axis=0) for loop in loops])
+        self.ab = self.b - self.a
+        self.ab_sq = np.maximum(np.sum(self.ab**2, 1), 1e-300)
+        # Outward normals of the segments, and the segments before and after each one in its loop
+        self.normals = np.stack((self.ab[:, 1], -self.ab[:, 0]), 1) / np.sqrt(self.ab_sq)[:, None]
+        starts = np.cumsum([0] + [len(loop) for loop in loops])
+        idx = np.arange(len(self.a))
+        self.prev = np.concatenate([np.roll(idx[s:e], 1) for s, e in zip(starts[:-1], starts[1:])])
+        self.next = np.concatenate([np.roll(idx[s:e], -1) for s, e in zip(starts[:-1], starts[1:])])
+
+        self.tree = None
+        if len(self.a) >= INDEX_MIN_SEGMENTS:
+            # The index holds the midpoints of pieces of the segments, no longer than twice the median
+            # segment, so that a few long segments (e.g. the sides of the outer square) do not weaken it
+            lengths = np.sqrt(self.ab_sq)
+            self.piece_length = 2 * np.median(lengths)
+            pieces = np.ceil(lengths / self.piece_length).astype(int)
+            self.owner = np.repeat(np.arange(len(self.a)), pieces)
+            frac = (np.arange(len(self.owner)) - np.repeat(np.cumsum(pieces) - pieces, pieces) + 0.5) \
+                   / pieces[self.owner]
+            self.tree = cKDTree(self.a[self.owner] + frac[:, None] * self.ab[self.owner])
+
+    @property
+    def num_segments(self):
+        return len(self.a)
+
+    def _nearest(self, p, segments = None):
+        # The nearest segment of each point (among 'segments', an array of candidates per point, if given),
+        # the position t along it of the nearest point, and the squared distance
+        a, ab, ab_sq = self.a, self.ab, self.ab_sq
+        if segments is not None:
+            a, ab, ab_sq = a[segments], ab[segments], ab_sq[segments]
+        ap = p[:, None, :] - a
+        t = np.clip(np.sum(ap * ab, -1) / ab_sq, 0, 1)
+        d_sq = np.sum((ap - t[..., None] * ab)**2, -1)
+        j = np.argmin(d_sq, 1)
+        rows = np.arange(len(p))
+        nearest = j if segments is None else segments[rows, j]
+        return nearest, t[rows, j], d_sq[rows, j]
+
+    def _nearest_indexed(self, p, k = 16):
+        # Candidates are the segments of the k nearest piece midpoints. The result is exact where the k-th
+        # midpoint is farther than the distance found plus half a piece; otherwise k is doubled
+        nearest = np.empty(len(p), dtype=int)
+        t = np.empty(len(p))
+        d_sq = np.empty(len(p))
+        todo = np.arange(len(p))
+        while len(todo):
+            k = min(k, len(self.owner))
+            chunk = max(1, CHUNK_ELEMENTS // k)
+            remaining = []
+            for start in range(0, len(todo), chunk):
+                rows = todo[start:start+chunk]
+                mid_dist, candidates = self.tree.query(p[rows], k)
+                n, tt, dd = self._nearest(p[rows], self.owner[candidates.reshape(len(rows), -1)])
+                nearest[rows], t[rows], d_sq[rows] = n, tt, dd
+                done = mid_dist.reshape(len(rows), -1)[:, -1] > np.sqrt(dd) + self.piece_length / 2
+                remaining.append(rows[~done])
+            if k == len(self.owner):
+                break
+            todo = np.concatenate(remaining)
+            k *= 2
+        return nearest, t, d_sq
+
+    def points(self, pts):
+        '''
+        points: The signed distance at each of an (N, 2) array of points
+
+        Returns - Array of N signed distances
+        '''
+        pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+        out = np.empty(len(pts))
+        chunk = max(1, CHUNK_ELEMENTS // (16 if self.tree is not None else self.num_segments))
+        for start in range(0, len(pts), chunk):
+            p = pts[start:start+chunk]
+            if self.tree is not None:
+                j, t, d_sq = self._nearest_indexed(p)
+            else:
+                j, t, d_sq = self._nearest(p)
+            out[start:start+chunk] = np.sqrt(d_sq) * self._signs(p, j, t)
+        return out
+
+    def _signs(self, p, j, t):
+        # +1 outside, -1 inside: the side of the nearest segment, or of the pseudo-normal at a nearest vertex
+        normal = self.normals[j].copy()
+        at_start, at_end = t <= 0, t >= 1
+        normal[at_start] += self.normals[self.prev[j[at_start]]]
+        normal[at_end] += self.normals[self.next[j[at_end]]]
+        closest = self.a[j] + t[:, None] * self.ab[j]
+        return np.where(np.sum((p - closest) * normal, 1) < 0, -1.0, 1.0)
+
+    def grid(self, n = 64, lb = 0, ub = 1):
+        '''
+        grid: The SDF on an n x n grid of points spanning [lb, ub] in x and y
+
+        Returns - (n, n) array whose rows are y and columns are x, like the 'sdf' of a DataPt loaded by get_graph()
+                  (its transpose is laid out like the 'sdf' cells of the .mat datasets and the output of calc_sdf)
+        '''
+        v = np.linspace(lb, ub, n)
+        return self.points(np.stack(np.meshgrid(v, v), -1).reshape(-1, 2)).reshape(n, n)
+
+
+def polyshape_sdfs(filenames, node_sets = None, n = 64, lb = 0, ub = 1):
+    '''
+    polyshape_sdfs: Computes the SDF grids (and node SDFs) of many shapes written by output_polyshape.m
+
+    filenames - The boundary files
+    node_sets - (Optional) A list with an (N_i, 2) array of mesh node coordinates per shape
+    n, lb, ub - The grid size and extent, see BoundarySDF.grid
+
+    Returns
+    - (B, n, n) array of SDF grids, laid out like the 'sdf' of DataPts loaded by get_graph()
+    - If node_sets is given, a list of arrays of node SDFs ('dt')
+    '''
+    grids, dts = [], []
+    for i, filename in enumerate(filenames):
+        sdf = BoundarySDF(read_polyshape(filename))
+        grids.append(sdf.grid(n, lb, ub))
+        if node_sets is not None:
+            dts.append(sdf.points(node_sets[i]))
+    grids = np.stack(grids)
+    return (grids, dts) if node_sets is not None else grids
+
+
+def main(args):
+    if len(args) not in (2, 3):
+        print("Enter input and output file names as command line arguments", file=sys.stderr)
+        return -1
+    sdf = BoundarySDF(read_polyshape(args[0]))
+    if len(args) == 2:
+        # Rows are x and columns are y, as written by calc_sdf
+        np.savetxt(args[1], sdf.grid(64, 0, 1).T, fmt='%f', delimiter=' ')
+    else:
+        np.savetxt(args[2], sdf.points(read_points(args[1])), fmt='%f')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
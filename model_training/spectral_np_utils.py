@@ -1,42 +1,102 @@
+import os
+import hashlib
+import warnings
+from collections import OrderedDict
+
 import numpy as np
 import scipy
 from scipy import linalg
+import scipy.sparse.linalg
+import scipy.spatial
 
 
-def generate_laplacian(edges, edge_weights):
+def generate_laplacian(edges, edge_weights, sparse = False):
     '''
     generate_laplacian: Generate a weighted Laplacian matrix for a graph
     
     edges - Array with 2 columns representing 1-directional edge pairs:
     [Index of 'from' node,   Index of 'to' node]
     edge_weights - Array of edge weights for each one-directional pair in 'edges'
+    sparse - If True, returns a scipy.sparse CSR matrix instead of a dense matrix
 
     Returns
     - NxN Laplacian matrix for the graph, where N is the largest index seen in 'edges'
     '''
     
     pairs = (edges[0].astype(int),edges[1].astype(int))
-    L = scipy.sparse.csr_matrix((-edge_weights,pairs)).tolil()
-    rows,_ = np.shape(L)
-    for i in range(rows):
-        L[i,i] = -np.sum(L[i,:])
-        
-    # Currently returns the dense matrix for simplicity:
+    n = max(np.max(pairs[0]), np.max(pairs[1])) + 1
+    W = scipy.sparse.csr_matrix((edge_weights,pairs), shape=(n,n))
+    L = -W
+    L.setdiag(np.asarray(W.sum(axis=1)).flatten())
+    L = L.tocsr()
+    
+    if sparse:
+        return L
     return L.todense()
 
 
-def norm_sym_laplacian(xy_data, sigma=1):
+def element_edges(elems):
+    '''
+    element_edges: Lists the edges of a triangle mesh
+    
+    elems - Array with one row per element, containing the (0-based) node indices of a
+    linear (3-node) or quadratic (6-node, corners then mid-side nodes) triangle
+    
+    Returns
+    - Array with 2 rows of unique, undirected edges [Index of one node, Index of the other node]
+    '''
+    elems = np.asarray(elems).astype(int)
+    if elems.shape[1] == 6:
+        loop = elems[:, [0, 3, 1, 4, 2, 5]]
+    else:
+        loop = elems[:, :3]
+    edges = np.stack((loop.flatten(), np.roll(loop, -1, axis=1).flatten()))
+    edges = np.sort(edges, axis=0)
+    return np.unique(edges, axis=1)
+
+
+def mesh_laplacian(elems, num_nodes = None, normalized = True):
+    '''
+    mesh_laplacian: Generate the sparse (unit-weight) Laplacian matrix of a triangle mesh
+    
+    elems - Element connectivity, see element_edges
+    num_nodes - The number of nodes in the mesh (optional, defaults to the largest index seen in 'elems')
+    normalized - If True, returns the normalized symmetric Laplacian I - D^-1/2 W D^-1/2
+    
+    Returns
+    - Sparse NxN Laplacian matrix (CSR) for the mesh
+    '''
+    edges = element_edges(elems)
+    if num_nodes is None:
+        num_nodes = np.max(edges) + 1
+    rows = np.concatenate((edges[0], edges[1]))
+    cols = np.concatenate((edges[1], edges[0]))
+    W = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_nodes, num_nodes))
+    D = np.asarray(W.sum(axis=1)).flatten()
+    if not normalized:
+        return (scipy.sparse.diags(D) - W).tocsr()
+    d = scipy.sparse.diags(np.where(D > 0, D, 1)**-.5)
+    return (scipy.sparse.identity(num_nodes) - d @ W @ d).tocsr()
+
+
+def norm_sym_laplacian(xy_data, sigma=1, radius=None, knn=None):
     '''
     generate_laplacian: Generate a normalized symmetric Laplacian matrix for a graph with nodes in 2D
     All pairwise distances are computed efficiently using np.outer()
     
     xydata - Array of coordinates with 2 columns: [x-coordinate, y-coordinate]
     sigma - Approximate standard deviation of distances between nodes
+    radius - (Optional) Only connect nodes closer than 'radius', giving a sparse matrix
+    knn - (Optional) Only connect each node to its 'knn' nearest neighbors, giving a sparse matrix
 
     Returns
     - NxN Laplacian matrix for the graph, where N is the largest index seen in 'edges'
+      (a scipy.sparse CSR matrix if 'radius' or 'knn' is given)
     '''
 
+    if radius is not None or knn is not None:
+        return _truncated_norm_sym_laplacian(xy_data, sigma, radius, knn)
+
     n,_ = np.shape(xy_data)
     x = xy_data[:,0]
     y = xy_data[:,1]
@@ -49,29 +109,92 @@ def norm_sym_laplacian(xy_data, sigma=1):
     return L
 
 
-def get_eigs(L, ne = None):
+# Above this many expected neighbors per point, a 'radius' neighborhood is slow to build and to factor
+DENSE_RADIUS_NEIGHBORS = 64
+
+
+def _truncated_norm_sym_laplacian(xy_data, sigma, radius, knn):
+    # Same Gaussian affinities as norm_sym_laplacian, but only between neighbors found with a k-d tree
+    n,_ = np.shape(xy_data)
+    if knn is None:
+        # The number of edges grows with radius**2: at res = 128, radius = 0.12 takes minutes where knn takes seconds
+        area = max(np.prod(np.ptp(xy_data, axis=0)), np.finfo(float).tiny)
+        expected = np.pi * radius**2 * n / area
+        if expected > DENSE_RADIUS_NEIGHBORS:
+            warnings.warn(f"radius = {radius} gives about {expected:.0f} neighbors per point among {n} points, "
+                          f"which is slow to build; use knn (e.g. knn = 16) or a smaller radius", stacklevel = 3)
+    tree = scipy.spatial.cKDTree(xy_data)
+    if knn is not None:
+        dist, nbr = tree.query(xy_data, k=min(knn + 1, n), distance_upper_bound=np.inf if radius is None else radius)
+        rows = np.repeat(np.arange(n), dist.shape[1])
+        keep = np.isfinite(dist.flatten()) & (nbr.flatten() != rows)
+        rows, cols, dist = rows[keep], nbr.flatten()[keep], dist.flatten()[keep]
+    else:
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+        rows, cols = pairs[:,0], pairs[:,1]
+        dist = np.linalg.norm(xy_data[rows] - xy_data[cols], axis=1)
+    W = scipy.sparse.csr_matrix((np.exp(-dist**2/sigma**2), (rows, cols)), shape=(n,n))
+    # Symmetrize (kNN is not symmetric), then add the self-affinities exp(0) = 1
+    W = W.maximum(W.T) + scipy.sparse.identity(n)
+    D = np.asarray(W.sum(axis=0)).flatten()
+    d = scipy.sparse.diags(D**-.5)
+    return (scipy.sparse.identity(n) - d @ W @ d).tocsr()
+
+
+def get_eigs(L, ne = None, method = 'auto'):
     '''
     get_eigs: Calculate the normalized eigenvectors (and eigenvalues) of a matrix L
     
-    L - The matrix for which to compute eigenvectors
+    L - The (symmetric) matrix for which to compute eigenvectors, dense or scipy.sparse
     ne - The number of eigenvectors to return, beginning with the
     smallest (optional, returns all eigenvectors by default)
+    method - The eigensolver to use:
+        'dense' - scipy.linalg.eigh on the full matrix
+        'shift-invert' - scipy.sparse.linalg.eigsh (Lanczos) in shift-invert mode around 0
+        'lobpcg' - scipy.sparse.linalg.lobpcg
+        'auto' - (default) 'shift-invert' if L is sparse and 'ne' is given, otherwise 'dense'
     
     Returns
     - E, the eigenvector matrix
     - w, the eigenvalues corresponding to eigenvectors in the columns of E
     '''
     
-    if ne is None:
-        w, v = scipy.linalg.eigh(L)
+    if method == 'auto':
+        method = 'shift-invert' if (scipy.sparse.issparse(L) and ne is not None) else 'dense'
+    
+    if method == 'dense':
+        if scipy.sparse.issparse(L):
+            L = L.toarray()
+        if ne is None:
+            w, v = scipy.linalg.eigh(L)
+        else:
+            w, v = scipy.linalg.eigh(L,subset_by_index=[0,ne-1])
+    elif method in ('shift-invert', 'lobpcg'):
+        if ne is None:
+            raise ValueError(f"get_eigs: method '{method}' requires the number of eigenvectors 'ne'")
+        w, v = _sparse_eigs(scipy.sparse.csr_matrix(L), ne, method)
     else:
-        w, v = scipy.linalg.eigh(L,subset_by_index=[0,ne-1])
+        raise ValueError(f"get_eigs: unknown method '{method}'")
     w,v = np.real(w),np.real(v)
     
     E = v/np.linalg.norm(v,axis=1).reshape(-1,1)
     return E, w
 
 
+def _sparse_eigs(L, ne, method):
+    # Partial eigendecomposition returning the 'ne' smallest eigenpairs, sorted ascending
+    n = L.shape[0]
+    v0 = np.random.RandomState(0).rand(n) # Fixed start vector, so results are reproducible
+    if method == 'shift-invert':
+        # Laplacians are positive semi-definite and singular, so shift slightly below 0
+        w, v = scipy.sparse.linalg.eigsh(L, k=ne, sigma=-1e-6, which='LM', v0=v0)
+    else:
+        X = np.random.RandomState(0).rand(n, ne)
+        w, v = scipy.sparse.linalg.lobpcg(L, X, largest=False, tol=1e-6, maxiter=max(500, 2*ne))
+    order = np.argsort(w)
+    return w[order], v[:, order]
+
+
 def pseudoinverse(E):
     '''
     pseudoinverse: Computes the Moore-Penrose (left) inverse of a matrix
@@ -86,7 +209,7 @@ def pseudoinverse(E):
     return Einv;
 
 
-def get_cvec(E, field):
+def get_cvec(E, field, Einv = None):
     '''
     get_cvec: Computes the coefficients c that minimize the squared error resulting
     from reconstructing a scalar field f as the product (E c)
@@ -94,17 +217,113 @@ def get_cvec(E, field):
     
     E - Eigenvector matrix, columns are eigenvectors
     f - Scalar field, same length as each column of 'E'
+    Einv - (Optional) The precomputed pseudoinverse of 'E', computed if not given
     
     Returns
     - The vector of coefficients such that (E c) approximates the input field
     '''
     
-    Einv = pseudoinverse(E)
+    if Einv is None:
+        Einv = pseudoinverse(E)
     field = field.reshape(-1,1)
     c = Einv @ field
     return c
 
 
+# Bump whenever the way the basis is computed changes, so stale files on disk are ignored
+BASIS_CACHE_VERSION = 1
+BASIS_MEMO_SIZE = 16
+_basis_memo = OrderedDict()
+
+
+def default_cache_dir():
+    '''
+    default_cache_dir: The directory used to store spectral bases on disk,
+    taken from the SSE_CACHE_DIR environment variable if it is set
+    '''
+    return os.environ.get('SSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'spectral_shape_encoding'))
+
+
+def _basis_paths(key, cache_dir):
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    stem = os.path.join(cache_dir, f"sse_basis_v{BASIS_CACHE_VERSION}_{digest}")
+    return {name: f"{stem}_{name}.npy" for name in ('E', 'w', 'Einv')}
+
+
+def _load_basis(key, cache_dir):
+    paths = _basis_paths(key, cache_dir)
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    try:
+        return tuple(np.load(paths[name]) for name in ('E', 'w', 'Einv'))
+    except (OSError, ValueError):
+        return None # Partially written or corrupted files are recomputed
+
+
+def _save_basis(key, cache_dir, basis):
+    paths = _basis_paths(key, cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, arr in zip(('E', 'w', 'Einv'), basis):
+            # Write to a temporary file first, so concurrent readers never see a partial file
+            tmp = f"{paths[name]}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, paths[name])
+    except OSError:
+        pass # The disk cache is only an optimization
+
+
+def get_sse_basis(n = 64, res = 16, k = 25, lb = 0, ub = 1, sigma = 1, cache_dir = None, radius = None, knn = None):
+    '''
+    get_sse_basis: Computes (or retrieves from cache) the spectral basis used by SSE
+    Bases are memoized in-process (least-recently-used first out) and stored on disk as .npy files
+    
+    n, res, k, lb, ub - See SSE
+    sigma - The standard deviation used for the Laplacian's Gaussian affinities
+    cache_dir - Directory of the on-disk cache, defaults to default_cache_dir(). Use False to disable it
+    radius, knn - (Optional) Truncate the Laplacian's affinities to a sparse neighborhood (see norm_sym_laplacian),
+    in which case a sparse eigensolver is used
+    
+    Returns
+    - E, the eigenvector matrix
+    - w, the eigenvalues corresponding to eigenvectors in the columns of E
+    - Einv, the pseudoinverse of E
+    The returned arrays are shared between callers and are read-only
+    '''
+    key = (n, res, k, lb, ub, sigma, radius, knn)
+    if key in _basis_memo:
+        _basis_memo.move_to_end(key)
+        return _basis_memo[key]
+    
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    basis = _load_basis(key, cache_dir) if cache_dir else None
+    if basis is None:
+        L = norm_sym_laplacian(sse_sample_points(res), sigma, radius, knn)
+        E, w = get_eigs(L, k)
+        basis = (E, w, pseudoinverse(E))
+        if cache_dir:
+            _save_basis(key, cache_dir, basis)
+    
+    for arr in basis:
+        arr.flags.writeable = False
+    _basis_memo[key] = basis
+    if len(_basis_memo) > BASIS_MEMO_SIZE:
+        _basis_memo.popitem(last=False)
+    return basis
+
+
+def sse_sample_points(res):
+    '''
+    sse_sample_points: The res*res grid of points (scaled to [0,1]) at which SSE samples an SDF
+    
+    Returns - Array of coordinates with 2 columns: [x-coordinate, y-coordinate]
+    '''
+    xp, yp = np.meshgrid(np.linspace(0,1,res), np.linspace(0,1,res))
+    return np.concatenate((xp.reshape(-1,1),yp.reshape(-1,1)),axis=1)
+
+
 class SSE():
     '''
     This class computes a Spectral Shape Encoding for a 2D Signed Distance Field
@@ -114,15 +333,27 @@ class SSE():
     k - Number of spectral coefficients to use for computing spectral coefficients
     lb - x (or y) coordinate of the southwest-most point on the SDF matrix
     ub - x (or y) coordinate of the northeast-most point on the SDF matrix
+    sigma - Standard deviation of the Gaussian affinities in the Laplacian
+    cache_dir - Directory for caching the spectral basis on disk (see get_sse_basis)
+    radius - (Optional) Only use affinities between sample points closer than 'radius'
+    knn - (Optional) Only use affinities between each sample point and its 'knn' nearest neighbors
+    With 'radius' or 'knn', the Laplacian is sparse, which makes high resolutions (res = 64-128) practical;
+    sigma should then be a few sample spacings, since the kernel is only truncated where it is negligible.
+    Prefer 'knn' at high resolutions: the number of neighbors within 'radius' grows with res**2 (at res = 128,
+    knn = 16 builds the basis in seconds, radius = 0.12 in minutes), and a warning is given above
+    DENSE_RADIUS_NEIGHBORS expected neighbors
 
     get_cvec(sdf) returns the coefficient vector 'c' to reconstruct 'sdf'
     '''
-    def __init__(self, n = 64, res = 16, k = 25, lb = 0, ub= 1):
+    def __init__(self, n = 64, res = 16, k = 25, lb = 0, ub= 1, sigma = 1, cache_dir = None, radius = None, knn = None):
         self.res = res
         self.ub = ub
         self.lb = lb
         self.n = n
         self.k = k
+        self.sigma = sigma
+        self.radius = radius
+        self.knn = knn
         
         xp = np.linspace(0,1,res)
         yp = np.linspace(0,1,res)
@@ -132,10 +363,31 @@ class SSE():
         self.xi = ((xp-lb)/span*(n-1)).astype(int)
         self.yi = ((yp-lb)/span*(n-1)).astype(int)
         
-        self.L = norm_sym_laplacian(np.concatenate((self.xp.reshape(-1,1),self.yp.reshape(-1,1)),axis=1), 1)
-        self.E, self.w = get_eigs(self.L, k)
+        self.E, self.w, self.Einv = get_sse_basis(n, res, k, lb, ub, sigma, cache_dir, radius, knn)
+
+    @property
+    def L(self):
+        # Only needed for inspection, so it is built on demand rather than with the (cached) basis
+        return norm_sym_laplacian(sse_sample_points(self.res), self.sigma, self.radius, self.knn)
 
     def cvec(self, sdf):
         z = sdf[np.ix_(self.xi, self.yi)]
-        c = get_cvec(self.E, z).flatten()
+        c = get_cvec(self.E, z, self.Einv).flatten()
         return c
+
+    def cvec_batch(self, sdfs, chunk_size = 4096):
+        '''
+        cvec_batch: Computes the coefficient vectors for a stack of SDFs at once
+        
+        sdfs - Array (or memory-mapped array) of shape (B, n, n) of SDF matrices
+        chunk_size - The number of SDFs encoded at a time, which bounds the memory used
+        
+        Returns - (B, k) array whose rows are the coefficient vectors cvec(sdfs[i])
+        '''
+        B = len(sdfs)
+        C = np.empty((B, self.k), dtype=np.result_type(sdfs.dtype, self.Einv.dtype))
+        for start in range(0, B, chunk_size):
+            # One gather of the sampled points and one matrix product per chunk
+            Z = np.asarray(sdfs[start:start+chunk_size])[:, self.xi[:,None], self.yi[None,:]]
+            C[start:start+chunk_size] = Z.reshape(len(Z), -1) @ self.Einv.T
+        return C
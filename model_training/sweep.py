@@ -0,0 +1,226 @@
+'''
+Sweeps of training runs (models x datasets x hyperparameters), run concurrently on a pool of processes
+
+Every dataset is converted once to the processed format (see save_processed_dataset) in the sweep directory,
+and every worker memory-maps it, so all workers read the same pages instead of each loading a copy.
+Each finished run saves its model and evaluation table, and its result is appended to one results store
+(results.jsonl). Runs save a checkpoint every epoch. Re-running an interrupted sweep skips the runs already
+in the store and continues unfinished runs from their last checkpoint.
+
+    datasets = {'stress_vor': {'wss': 'data/stress_vor_w.mat', 'oss': 'data/stress_vor_o.mat', 'scale': 10000}}
+    configs = sweep_grid(dataset = ['stress_vor'], model = ['SSENet'], lr = [1e-3, 3e-4], epochs = [50])
+    results = run_sweep(configs, datasets, 'sweeps/lr', num_workers = 4)
+
+Or from the command line, with the same arguments in a JSON file (re-run the same command to resume):
+    python sweep.py sweep.json
+'''
+import os
+import sys
+import json
+import random
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+
+from models import *
+from evaluation import evaluation_table
+from checkpointing import latest_checkpoint
+
+CONFIG_KEYS = ('dataset', 'model', 'model_kwargs', 'seed') # All other keys of a config are train_model() arguments
+
+
+def sweep_grid(**axes):
+    '''
+    sweep_grid: Builds the configs for every combination of the values given
+
+    axes - Lists of values, by config key:
+           dataset - Names of datasets (keys of the 'datasets' passed to run_sweep)
+           model - Names of model classes ('SSENet' or 'SSENetCustom'), defaults to ['SSENet']
+           model_kwargs - Dictionaries of model arguments, e.g. [{'which_inputs': (1, 0, 1)}], defaults to [{}]
+           seed - Random seeds for the model initialization and training order, defaults to [0]
+           Any other key is passed to train_model(), e.g. lr = [1e-3, 3e-4], epochs = [50]
+
+    Returns - A list of config dictionaries
+    '''
+    axes.setdefault('model', ['SSENet'])
+    axes.setdefault('model_kwargs', [{}])
+    axes.setdefault('seed', [0])
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(axes[name] for name in names))]
+
+
+def run_id(config):
+    # A name that identifies a config across restarts of a sweep
+    key = json.dumps(config, sort_keys = True, default = str)
+    return f"{config['dataset']}-{config['model']}-{hashlib.sha1(key.encode()).hexdigest()[:10]}"
+
+
+def prepare_datasets(datasets, dirname, dtype = torch.double):
+    '''
+    prepare_datasets: Converts the datasets of a sweep to the processed format, once
+
+    datasets - Dictionary of dataset name -> {'wss': .mat file(s), 'oss': .mat file(s) (optional), 'scale': ...};
+               several files are concatenated, e.g. to combine the Voronoi and Lattice sets
+    dirname - The directory to write the processed datasets to (<dirname>/<name>/wss and .../oss).
+              Datasets already converted there are kept
+    dtype - The floating point type to store
+
+    Returns - Dictionary of dataset name -> {'wss': directory, 'oss': directory (if any)}
+    '''
+    dirs = {}
+    for name, spec in datasets.items():
+        dirs[name] = {}
+        for part in ('wss', 'oss'):
+            files = spec.get(part)
+            if not files:
+                continue
+            files = [files] if isinstance(files, str) else files
+            out = os.path.join(dirname, name, part)
+            # meta.json is written last, so it marks a complete conversion
+            if not os.path.exists(os.path.join(out, 'meta.json')):
+                dataset = []
+                for filename in files:
+                    dataset += load_matlab_dataset(filename, spec.get('scale', 10000), dtype)
+                save_processed_dataset(dataset, out)
+            dirs[name][part] = out
+    return dirs
+
+
+def _run_config(args):
+    # Worker of run_sweep: trains and evaluates one config, and saves its model and evaluation table
+    config, run_dir, dataset_dirs, threads = args
+    torch.set_num_threads(threads)
+    wss = load_processed_dataset(dataset_dirs['wss'])
+    oss = load_processed_dataset(dataset_dirs['oss']) if 'oss' in dataset_dirs else []
+    idxs_tr, idxs_val = get_split_indices(wss)
+
+    random.seed(config['seed'])
+    torch.manual_seed(config['seed'])
+    dtype = torch.from_numpy(wss.arrays['x'][:0]).dtype
+    model = MODEL_CLASSES[config['model']](**config['model_kwargs'], dtype = dtype)
+    train_kwargs = {k: v for k, v in config.items() if k not in CONFIG_KEYS}
+    checkpoints = os.path.join(run_dir, 'checkpoints')
+    resume = checkpoints if latest_checkpoint(checkpoints) else None
+    model, loss_hist, val_hist, train_time = train_model(model, wss, idxs_tr, idxs_val, print_progress = False,
+                                                         checkpoint_dir = checkpoints, resume = resume, **train_kwargs)
+
+    save_model(model, os.path.join(run_dir, 'model.pt.tmp'))
+    os.replace(os.path.join(run_dir, 'model.pt.tmp'), os.path.join(run_dir, 'model.pt'))
+    table = evaluation_table(model, wss, idxs_tr, idxs_val, oss)
+    np.save(os.path.join(run_dir, 'evaluation.npy'), table)
+
+    summary = {}
+    for part in ('train', 'test', 'oss'):
+        rows = table[table['set'] == part]
+        if len(rows):
+            summary[part] = {'median_r2': float(np.median(rows['r2'])), 'mean_mse': float(np.mean(rows['mse']))}
+    return {'loss_hist': [float(v) for v in loss_hist], 'val_hist': [float(v) for v in val_hist],
+            'train_time': train_time, 'evaluation': summary}
+
+
+def load_results(sweep_dir, include_failed = False):
+    '''
+    load_results: Reads the results store of a sweep
+
+    Returns - A list of result dictionaries ('run_id', 'config', 'loss_hist', 'val_hist', 'train_time',
+              'evaluation' with the median R2 and mean MSE of each set, 'model' and 'evaluation_table' file names),
+              the latest for each run. Runs that raised an error have an 'error' instead, and are left out
+              unless include_failed is True
+    '''
+    results = {}
+    filename = os.path.join(sweep_dir, 'results.jsonl')
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue # A line cut short by an interruption
+            results[result['run_id']] = result
+    return [r for r in results.values() if include_failed or 'error' not in r]
+
+
+def run_sweep(configs, datasets, sweep_dir, num_workers = None, threads_per_worker = 1,
+              dtype = torch.double, dataset_dir = None):
+    '''
+    run_sweep: Trains and evaluates every config on a pool of processes, skipping the runs already completed
+
+    configs - A list of config dictionaries, e.g. from sweep_grid()
+    datasets - The dataset specifications, see prepare_datasets()
+    sweep_dir - The directory of the sweep, holding results.jsonl and one directory per run under runs/
+    num_workers - The number of processes, defaults to the number of CPUs divided by threads_per_worker
+    threads_per_worker - The number of threads each worker uses for intra-op parallelism
+    dtype - The floating point type of the data and models
+    dataset_dir - Where to keep the processed datasets, defaults to <sweep_dir>/datasets
+                  (a directory on /dev/shm keeps them in RAM)
+
+    Returns - The results of all completed runs, see load_results()
+    '''
+    if num_workers is None:
+        num_workers = max(1, os.cpu_count() // threads_per_worker)
+    for config in configs:
+        config.setdefault('model', 'SSENet')
+        config.setdefault('model_kwargs', {})
+        config.setdefault('seed', 0)
+        if config['dataset'] not in datasets:
+            raise ValueError(f"Unknown dataset '{config['dataset']}' in config {config}")
+
+    os.makedirs(sweep_dir, exist_ok = True)
+    used = {config['dataset'] for config in configs}
+    dataset_dirs = prepare_datasets({name: datasets[name] for name in sorted(used)},
+                                    dataset_dir or os.path.join(sweep_dir, 'datasets'), dtype)
+
+    done = {r['run_id'] for r in load_results(sweep_dir)}
+    pending = [c for c in configs if run_id(c) not in done]
+    print(f"{len(configs) - len(pending)} of {len(configs)} runs already completed, "
+          f"running {len(pending)} on {num_workers} processes", flush = True)
+
+    with open(os.path.join(sweep_dir, 'results.jsonl'), 'a') as store, \
+         ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+        futures = {}
+        for config in pending:
+            run_dir = os.path.join(sweep_dir, 'runs', run_id(config))
+            args = (config, run_dir, dataset_dirs[config['dataset']], threads_per_worker)
+            futures[executor.submit(_run_config, args)] = (config, run_dir)
+        for n, future in enumerate(as_completed(futures)):
+            config, run_dir = futures[future]
+            result = {'run_id': run_id(config), 'config': config}
+            try:
+                result.update(future.result())
+                result['model'] = os.path.join(run_dir, 'model.pt')
+                result['evaluation_table'] = os.path.join(run_dir, 'evaluation.npy')
+                status = f"test median R2 {result['evaluation']['test']['median_r2']:.4f}" \
+                         if 'test' in result['evaluation'] else "done"
+            except Exception as e:
+                result['error'] = repr(e)
+                status = f"failed: {e!r}"
+            # Only this process writes to the store, one complete line per run
+            store.write(json.dumps(result, default = str) + '\n')
+            store.flush()
+            os.fsync(store.fileno())
+            print(f"[{n + 1}/{len(pending)}] {result['run_id']}: {status}", flush = True)
+
+    return load_results(sweep_dir)
+
+
+def main(filename):
+    '''
+    Runs a sweep described by a JSON file with the keys:
+    'sweep_dir', 'datasets' (see prepare_datasets), and either 'grid' (the arguments of sweep_grid)
+    or 'configs' (a list of configs); optionally 'num_workers', 'threads_per_worker' and 'float32'
+    '''
+    with open(filename) as f:
+        spec = json.load(f)
+    configs = spec['configs'] if 'configs' in spec else sweep_grid(**spec['grid'])
+    results = run_sweep(configs, spec['datasets'], spec['sweep_dir'], spec.get('num_workers'),
+                        spec.get('threads_per_worker', 1), torch.float if spec.get('float32') else torch.double)
+    print(f"{len(results)} runs completed, results in {os.path.join(spec['sweep_dir'], 'results.jsonl')}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,148 @@
+'''
+Synthetic geometries in the layout of the real datasets, for benchmarks and tests that
+should not depend on the MATLAB-generated .mat files
+
+A geometry is the unit square with random star-shaped holes. Its boundary is a list of closed loops
+(the outer boundary counter-clockwise, the holes clockwise), the nodes are a Delaunay triangulation
+of the material, and the SDF is computed exactly from the boundary segments by sdf_utils.BoundarySDF
+(negative inside the material, positive outside, as polySDF.m).
+'''
+import numpy as np
+from scipy import io
+from scipy.spatial import Delaunay
+
+from data_loading import *
+from sdf_utils import BoundarySDF
+
+
+def random_boundary(rng, num_holes = 4, num_vertices = 64, min_wall = 0.03):
+    '''
+    random_boundary: Draws the boundary of the unit square with random non-overlapping star-shaped holes
+
+    rng - A np.random.RandomState
+    num_holes - The number of holes (fewer are returned if they do not fit)
+    num_vertices - The number of vertices of each hole
+    min_wall - The smallest distance between two holes, or between a hole and the outer boundary
+
+    Returns - A list of (m, 2) arrays of loop vertices: the outer boundary first (counter-clockwise),
+              then one per hole (clockwise)
+    '''
+    loops = [np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)]
+    circles = []
+    theta = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    for _ in range(50 * num_holes):
+        if len(circles) == num_holes:
+            break
+        r0 = rng.uniform(0.06, 0.18)
+        amps = rng.uniform(0, 0.25, 3) / np.arange(1, 4)
+        r_max = r0 * (1 + amps.sum())
+        center = rng.uniform(r_max + min_wall, 1 - r_max - min_wall, 2)
+        if any(np.hypot(*(center - c)) < r_max + r + min_wall for c, r in circles):
+            continue
+        circles.append((center, r_max))
+        phases = rng.uniform(0, 2 * np.pi, 3)
+        r = r0 * (1 + sum(a * np.cos((k + 2) * theta + p) for k, (a, p) in enumerate(zip(amps, phases))))
+        # Clockwise, so that the material is on the left of every boundary segment
+        loops.append(center + np.stack((r * np.cos(-theta), r * np.sin(-theta)), 1))
+    return loops
+
+
+def resample_loop(loop, spacing):
+    # Points along a closed loop, at most 'spacing' apart, including its vertices
+    points = []
+    for p, q in zip(loop, np.roll(loop, -1, axis=0)):
+        m = max(1, int(np.ceil(np.hypot(*(q - p)) / spacing)))
+        points.append(p + np.arange(m)[:, None] / m * (q - p))
+    return np.concatenate(points)
+
+
+def triangulate(loops, num_nodes, rng):
+    '''
+    triangulate: Meshes the material inside a boundary with roughly 'num_nodes' nodes
+
+    Nodes are placed along the boundary and on a jittered grid inside it, and triangulated with Delaunay;
+    triangles outside the material are dropped
+
+    Returns
+    - (n, 2) array of node coordinates
+    - (m, 3) array of (0-based) node indices of each triangle
+    '''
+    sdf = BoundarySDF(loops)
+    a, b = sdf.a, sdf.b
+    area = abs(np.sum(a[:, 0] * b[:, 1] - b[:, 0] * a[:, 1])) / 2
+    perimeter = np.sum(np.sqrt(sdf.ab_sq))
+    # Spacing h such that (area / h^2 interior) + (perimeter / h boundary) nodes make num_nodes
+    h = (perimeter + np.sqrt(perimeter**2 + 4 * area * num_nodes)) / (2 * num_nodes)
+    boundary = np.concatenate([resample_loop(loop, h) for loop in loops])
+
+    g = np.arange(h / 2, 1, h)
+    grid = np.stack(np.meshgrid(g, g), -1).reshape(-1, 2) + rng.uniform(-0.2 * h, 0.2 * h, (len(g)**2, 2))
+    interior = grid[sdf.points(grid) < -0.4 * h]
+
+    nodes = np.concatenate((boundary, interior))
+    tri = Delaunay(nodes).simplices
+    keep = sdf.points(nodes[tri].mean(1)) < 0
+    return nodes, tri[keep]
+
+
+def synthetic_field(nodes, dt, rng):
+    # A smooth stress-like field: concentrated near the boundary, varying across the part (same scale as the datasets)
+    k = rng.uniform(1, 3, 2)
+    wave = 1 + 0.3 * np.sin(2 * np.pi * k[0] * nodes[:, 0]) * np.cos(2 * np.pi * k[1] * nodes[:, 1])
+    return 10000 * wave * (0.5 + np.exp(-np.abs(dt) / 0.05))
+
+
+def synthetic_geometry(rng, num_nodes = 2000, num_holes = 4, n = 64):
+    '''
+    synthetic_geometry: Creates one random geometry, in the form returned by get_graph()
+
+    rng - A np.random.RandomState
+    num_nodes - The approximate number of mesh nodes
+    num_holes - The number of holes
+    n - The size of the (n x n) SDF grid over the unit square
+
+    Returns - A DataPt with x = [x, y, node SDF], y = a synthetic scalar field, sdf and elem
+    '''
+    loops = random_boundary(rng, num_holes)
+    nodes, elems = triangulate(loops, num_nodes, rng)
+    boundary = BoundarySDF(loops)
+    dt = boundary.points(nodes)
+    sdf = boundary.grid(n)
+    data = DataPt(x = np.concatenate((nodes, dt[:, None]), axis=1),
+                  y = synthetic_field(nodes, dt, rng)[:, None], sdf = sdf)
+    data.elem = elems
+    return data
+
+
+def synthetic_dataset(num_graphs, num_nodes = 2000, seed = 0, **kwargs):
+    '''
+    synthetic_dataset: Creates a dataset of random geometries, as load_matlab_dataset() would load it
+
+    num_graphs - The number of geometries
+    num_nodes - The approximate number of mesh nodes of each geometry
+    seed - The random seed
+    kwargs - Any arguments of prepare_datapt() (scale, dtype, interp_sizes, pool_sizes, keep_sdf)
+
+    Returns - The dataset as a list of DataPt objects
+    '''
+    rng = np.random.RandomState(seed)
+    dataset = [synthetic_geometry(rng, num_nodes) for _ in range(num_graphs)]
+    cvecs = SSE(k = 50).cvec_batch(np.stack([data.sdf for data in dataset]))
+    return [prepare_datapt(data, c, **kwargs) for data, c in zip(dataset, cvecs)]
+
+
+def write_synthetic_mat(filename, num_graphs, num_nodes = 2000, seed = 0):
+    '''
+    write_synthetic_mat: Writes a .mat file of random geometries, laid out like the real datasets
+    (see generate_matlab_dataset.m), that can be read by load_matlab_dataset()
+    '''
+    rng = np.random.RandomState(seed)
+    cells = {name: np.empty((num_graphs, 1), dtype=object) for name in MAT_VARIABLES}
+    for i in range(num_graphs):
+        data = synthetic_geometry(rng, num_nodes)
+        cells['nodes'][i, 0] = data.x[:, :2].T
+        cells['elem'][i, 0] = (data.elem + 1).T.astype(float)
+        cells['stress'][i, 0] = data.y
+        cells['dt'][i, 0] = data.x[:, 2:]
+        cells['sdf'][i, 0] = data.sdf.T
+    io.savemat(filename, cells)